@@ -0,0 +1,240 @@
+import argparse
+import gc
+import json
+import os
+import platform
+import random
+import subprocess
+import tempfile
+import time
+import tracemalloc
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+
+from ruamel.yaml import YAML
+
+import onboarding_utils
+from onboarding_utils import LOADERS, AbelConfig, BuildingConfig, load_config, register_loader
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+register_loader('safe_pure', lambda: YAML(typ='safe', pure=True))
+
+ENTITY_TYPES = ['HVAC/AHU_STANDARD', 'HVAC/VAV_SD_DSP', 'HVAC/FCU_DFSS_DSP', 'METERS/EM_PWM_SINGLE', 'LIGHTING/LG_SS']
+VIRTUAL_TYPES = ['HVAC/ZONE_TC', 'HVAC/VAV_SD_CSP', 'FACILITIES/FLOOR_MONITOR']
+
+
+def _guid(rng):
+    return str(uuid.UUID(int=rng.getrandbits(128), version=4))
+
+
+def generate_configs(num_entities, virtual_ratio=0.2, fan_out=5, max_fields=12, missing_ratio=0.01, seed=0):
+    '''
+    Generates building config export and ABEL config yaml with num_entities entities.
+    Reporting entities carry translation blocks, virtual entities carry links to fan_out reporting entities.
+    Args:
+        num_entities: number of reporting and virtual entities
+        virtual_ratio: share of virtual entities
+        fan_out: number of reporting entities linked from every virtual entity
+        max_fields: max number of translated fields per reporting entity
+        missing_ratio: share of ABEL entities that are not in the building config yet
+        seed: random seed, same arguments always give the same configs
+    Returns:
+        (building_config, abel_config) yaml strings
+    '''
+    rng = random.Random(seed)
+    num_virtual = int(num_entities * virtual_ratio)
+    num_reporting = num_entities - num_virtual
+
+    building = [f"{_guid(rng)}:", "  code: US-SVL-BLDG1", "  type: FACILITIES/BUILDING", "  etag: '1000'"]
+    abel = ["CONFIG_METADATA:", "  operation: UPDATE"]
+
+    reporting_guids = []
+    for i in range(num_reporting):
+        guid = _guid(rng)
+        reporting_guids.append(guid)
+        entity = [f"  code: DEV-{i}", f"  type: {rng.choice(ENTITY_TYPES)}", f"  cloud_device_id: '{2000000000 + i}'", "  translation:"]
+        for j in range(rng.randint(1, max_fields)):
+            entity += [f"    field_{j}_sensor:", f"      present_value: points.point_{j}.present_value",
+                       "      units:", f"        key: pointset.points.point_{j}.units",
+                       "        values:", "          degrees_celsius: degC"]
+        if rng.random() >= missing_ratio:
+            building += [f"{guid}:", f"  etag: '{rng.getrandbits(40)}'"] + entity
+        abel += [f"{guid}:"] + entity + ["  operation: UPDATE", "  update_mask: [TYPE, TRANSLATION]"]
+
+    for i in range(num_virtual):
+        guid = _guid(rng)
+        entity = [f"  code: VIRTUAL-{i}", f"  type: {rng.choice(VIRTUAL_TYPES)}", "  links:"]
+        for link in rng.sample(reporting_guids, min(fan_out, len(reporting_guids))):
+            entity += [f"    {link}:", "      zone_air_temperature_sensor: field_0_sensor"]
+        if rng.random() < 0.5:
+            building += [f"{guid}:", f"  etag: '{rng.getrandbits(40)}'"] + entity
+            abel += [f"{guid}:"] + entity + ["  operation: UPDATE", "  update_mask: [LINKS]"]
+        else:
+            abel += [f"{guid}:"] + entity + ["  operation: ADD"]
+
+    return '\n'.join(building) + '\n', '\n'.join(abel) + '\n'
+
+
+def _peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return round(peak / (2**20 if platform.system() == 'Darwin' else 2**10), 1)
+
+
+def run_case(num_entities, operation, abel_loader='rt', seed=0):
+    '''
+    Generates configs and times parse, transform and emit of one exporter. Run in a fresh process for a meaningful peak RSS.
+    Args:
+        num_entities: number of entities in the generated configs
+        operation: 'update', 'add-virtual' or 'update-etags'
+        abel_loader: loader for the ABEL config
+    '''
+    building_text, abel_text = generate_configs(num_entities, seed=seed)
+    timings = {'parse': 0.0, 'transform': 0.0, 'emit': 0.0}
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        dump_path = os.path.join(tmp_dir, 'onboard.yaml')
+        if operation == 'update-etags':
+            # onboard config for etag updates is the first exported update chunk
+            onboarding_utils.export_update_config(BuildingConfig(load_config(building_text)), AbelConfig(load_config(abel_text)),
+                                                  True, dump_path, max_items=10**9)
+            with open(dump_path.replace('.yaml', '_pt1.yaml'), 'r') as f:
+                abel_text = f.read()
+
+        start = time.perf_counter()
+        building_config = BuildingConfig(load_config(building_text))
+        abel_config = AbelConfig(load_config(abel_text, loader=abel_loader))
+        timings['parse'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        if operation == 'update':
+            status = onboarding_utils.export_update_config(building_config, abel_config, True, dump_path)
+        elif operation == 'add-virtual':
+            status = onboarding_utils.export_add_config(building_config, abel_config, True, dump_path)
+        elif operation == 'update-etags':
+            status = onboarding_utils.update_etags(building_config, abel_config, dump_path)
+        else:
+            raise ValueError(f'Unknown operation: {operation}')
+        timings['emit'] = status['performance']['stages'].get('emit', 0.0)
+        timings['transform'] = time.perf_counter() - start - timings['emit']
+
+    return {
+            'entities': num_entities,
+            'operation': operation,
+            'abel_loader': abel_loader,
+            'input_mb': round((len(building_text) + len(abel_text)) / 2**20, 1),
+            'files': len(status['saved_files']),
+            'errors': len(status['errors']),
+            'seconds': {stage: round(seconds, 3) for stage, seconds in timings.items()},
+            'peak_rss_mb': _peak_rss_mb()
+            }
+
+
+def benchmark_exporters(sizes, operations, abel_loader='rt'):
+    '''
+    Runs every operation for every config size, each case in a fresh process.
+    '''
+    results = []
+    for size in sizes:
+        for operation in operations:
+            with ProcessPoolExecutor(max_workers=1) as executor:
+                result = executor.submit(run_case, size, operation, abel_loader).result()
+            results.append(result)
+            seconds = result['seconds']
+            print(f"{size:>8} entities  {operation:<13} parse {seconds['parse']:8.3f} s  transform {seconds['transform']:8.3f} s  "
+                  f"emit {seconds['emit']:8.3f} s  peak RSS {result['peak_rss_mb']} MB")
+    return results
+
+
+def benchmark_loaders(sizes, loaders, config='building'):
+    '''
+    Measures parse time, peak traced memory and memory held by the loaded config for every loader and config size.
+    Args:
+        sizes: list of numbers of entities
+        loaders: list of loader names from LOADERS
+        config: 'building' or 'abel', generated config to load
+    '''
+    results = []
+    for size in sizes:
+        building_text, abel_text = generate_configs(size, virtual_ratio=0)
+        config_text = abel_text if config == 'abel' else building_text
+        for loader in loaders:
+            start = time.perf_counter()
+            load_config(config_text, loader=loader)
+            elapsed = time.perf_counter() - start
+
+            # separate pass, tracemalloc slows down allocation-heavy parsing
+            gc.collect()
+            tracemalloc.start()
+            loaded = load_config(config_text, loader=loader)
+            gc.collect()
+            retained, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            del loaded
+            results.append({'entities': size, 'loader': loader, 'seconds': round(elapsed, 3), 'peak_mb': round(peak / 2**20, 1),
+                            'retained_mb': round(retained / 2**20, 1), 'bytes_per_entity': round(retained / size)})
+            print(f"{size:>8} entities  {loader:<10} {elapsed:8.3f} s  peak {peak / 2**20:8.1f} MB  "
+                  f"retained {retained / 2**20:8.1f} MB  {retained / size:8.0f} B/entity")
+    return results
+
+
+def compare_results(results, baseline):
+    '''
+    Prints time and memory ratios of results to the baseline results with the same size and operation.
+    '''
+    baseline_cases = {(case['entities'], case['operation']): case for case in baseline['results']}
+    print(f"Compared to {baseline.get('commit')} ({baseline.get('timestamp')}):")
+    for case in results:
+        base = baseline_cases.get((case['entities'], case['operation']))
+        if base is None:
+            continue
+        ratios = [f"{stage} x{case['seconds'][stage] / base['seconds'][stage]:.2f}"
+                  for stage in case['seconds'] if base['seconds'].get(stage)]
+        if case['peak_rss_mb'] and base.get('peak_rss_mb'):
+            ratios.append(f"peak RSS x{case['peak_rss_mb'] / base['peak_rss_mb']:.2f}")
+        print(f"{case['entities']:>8} entities  {case['operation']:<13} {'  '.join(ratios)}")
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the exporters on synthetic building and ABEL configs.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000])
+    parser.add_argument('--operations', nargs='+', choices=['update', 'add-virtual', 'update-etags'], default=['update', 'add-virtual', 'update-etags'])
+    parser.add_argument('--abel-loader', default='rt', help='loader for the ABEL config')
+    parser.add_argument('--loaders', nargs='+', default=None, help=f"only compare config loaders instead, e.g. {' '.join(LOADERS)}")
+    parser.add_argument('--config', choices=['building', 'abel'], default='building', help='generated config to compare the loaders on')
+    parser.add_argument('--output', default=None, help='path to save JSON results to')
+    parser.add_argument('--compare', default=None, help='path to JSON results of an earlier run to compare with')
+    args = parser.parse_args()
+
+    if args.loaders:
+        results = benchmark_loaders(args.sizes, args.loaders, args.config)
+    else:
+        results = benchmark_exporters(args.sizes, args.operations, args.abel_loader)
+
+    run = {
+            'commit': _git_commit(),
+            'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'results': results
+            }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(run, f, indent=2)
+    if args.compare and not args.loaders:
+        with open(args.compare, 'r') as f:
+            compare_results(results, json.load(f))
@@ -8,81 +8,114 @@ from ruamel.yaml import YAML
 yaml = YAML(typ='rt')
 
 from onboarding_utils import *
+from stubby_utils import *
 
 # UI
 tab_config_exporter, tab_stubby = st.tabs(["Config Exporter", "Stubby Commands"])
 
 
-def clear_folder(folder_path):
+@st.cache_resource
+def get_config_cache():
     """
-    Removes all files from the specified folder.
-    Leaves subdirectories intact.
+    Parsed configs shared across reruns, keyed by SHA-256 of the uploaded file.
     """
-    if not os.path.exists(folder_path):
-        print(f"Error: Folder '{folder_path}' does not exist.")
+    return ConfigCache(max_entries=8)
+
+
+def show_performance(status):
+    """
+    Expandable panel with stage timings, counters and memory peaks of an exporter call.
+    """
+    performance = status.get('performance')
+    if not performance:
         return
+    with st.expander("Performance"):
+        st.write(f"Total: {performance['total_seconds']} s")
+        stages = pd.DataFrame({'seconds': performance['stages']})
+        if performance.get('peak_memory_mb'):
+            stages['peak memory, MB'] = pd.Series(performance['peak_memory_mb'])
+        st.dataframe(stages)
+        st.write(performance['counters'])
+
+
+def show_validation(report):
+    """
+    Expandable panel with the results of validate_configs, open if errors were found.
+    """
+    with st.expander(f"Validation: {len(report['errors'])} errors", expanded=len(report['errors']) > 0):
+        st.write(report['entities'])
+        if len(report['errors']) > 0:
+            st.write([_ for _ in report['errors']])
+
+
+@st.fragment(run_every=1)
+def show_bulk_progress(job):
+    """
+    Progress of a running bulk export, refreshed every second without rerunning the rest of the app.
+    """
+    exported, total = job.progress()
+    st.progress(exported / total if total else 1.0, text=f"{exported}/{total} buildings exported")
+    if job.done:
+        st.rerun()
+
+
+def show_operation_states(results):
+    """
+    Table with the state of every polled operation.
+    """
+    st.dataframe(pd.DataFrame({'state': {result['operation_id']: result['error'] or ('done' if result['done'] else 'running') for result in results}}))
+
+
+@st.fragment(run_every=1)
+def show_operations_progress(poll):
+    """
+    State of operations being polled, refreshed every second without rerunning the rest of the app.
+    """
+    show_operation_states(poll.states())
+    if poll.done:
+        st.rerun()
 
-    for filename in os.listdir(folder_path):
-        file_path = os.path.join(folder_path, filename)
-        try:
-            if os.path.isfile(file_path) or os.path.islink(file_path):
-                os.unlink(file_path)  # os.unlink is an alias for os.remove
-            # else:
-            #     print(f"Skipping directory: {file_path}")
-        except OSError as e:
-            print(f"Error deleting file {file_path}: {e}")
-    print(f"All files removed from '{folder_path}'.")
 
 with tab_config_exporter:
     helper_option = st.selectbox(
         "Select operation",
-        ("Export Reporting Entity Config", "Export Virtual Entity Config", "Update Etags"),
+        ("Export Reporting Entity Config", "Export Virtual Entity Config", "Update Etags", "Bulk Export"),
         index=None,
         placeholder="Select operation...",
     )
+    with st.sidebar:
+        st.subheader("Performance")
+        trace_memory = st.checkbox("Trace memory peaks (slower)", value=False)
+        trace_path = st.text_input("Save performance trace to (optional)")
     if helper_option=="Export Reporting Entity Config":
         file_export_path = st.text_input("File Export Path")
         building_config_file = st.file_uploader("Building Config", type=None, accept_multiple_files=False, key=None, help=None, on_change=None)
         abel_config_file = st.file_uploader("ABEL Config", type=None, accept_multiple_files=False, key=None, help=None, on_change=None)
         use_abel_flags = st.checkbox("Use 'operation' and 'update_mask' from ABEL config", value=True)
+        only_changed_entities = st.checkbox("Only export entities that differ from the building config, with 'update_mask' narrowed to the changed fields", value=False)
+        max_bytes = st.number_input("Max bytes per file (0: split by number of entities only)", min_value=0, value=0, step=10000)
+        max_fields = st.number_input("Max translated fields per file (0: split by number of entities only)", min_value=0, value=0, step=100)
+        stream_building_config = st.checkbox("Streaming building config ingestion (for very large exports, keeps only type, etag, code, translation and links)", value=False)
+        compact_abel_config = st.checkbox("Compact ABEL config (for very large configs, comments and styling are not kept)", value=False)
 
         abel_config = None
         building_config = None
 
-        save_folder = "files"
-        clear_folder(f'./{save_folder}')
-
-        if not os.path.exists(save_folder):
-            os.makedirs(save_folder)
-
         if building_config_file:
-            building_config_bytes = building_config_file.read()
-            building_config_bytes = building_config_bytes.decode("UTF-8")
-
-            with open(f"{save_folder}/{building_config_file.name}", "w") as f:
-                f.write(building_config_bytes)
-
-            with open(f"{save_folder}/{building_config_file.name}", 'r') as f:
-                building_config = yaml.load(f)
-                f.close()
-            os.remove(f"{save_folder}/{building_config_file.name}")
-
-        if abel_config_file:     
-            abel_config_bytes = abel_config_file.read()
-            abel_config_bytes = abel_config_bytes.decode("UTF-8")
+            building_config = get_config_cache().load(building_config_file.getvalue(), BuildingConfig, loader='stream' if stream_building_config else 'safe')
 
-            with open(f"{save_folder}/{abel_config_file.name}", "w") as f:
-                f.write(abel_config_bytes)
+        if abel_config_file:
+            abel_config = get_config_cache().load(abel_config_file.getvalue(), AbelConfig, loader='compact' if compact_abel_config else 'rt')
 
-            with open(f"{save_folder}/{abel_config_file.name}", 'r') as f:
-                abel_config = yaml.load(f)
-                f.close()
-            clear_folder(f'./{save_folder}')
+        if building_config and abel_config:
+            show_validation(validate_configs(building_config, abel_config, 'update', use_abel_flags))
 
         export = st.button("Export")
         if export:
             if building_config and abel_config and file_export_path:
-                status = export_update_config(building_config, abel_config, use_abel_flags, file_export_path)
+                status = export_update_config(building_config, abel_config, use_abel_flags, file_export_path,
+                                              max_bytes=max_bytes or None, max_fields=max_fields or None, delta=only_changed_entities,
+                                              perf=Instrumentation(trace_memory, trace_path or None))
 
                 if len(status['errors']) > 0:
                     st.write("Errors found:")
@@ -90,9 +123,15 @@ with tab_config_exporter:
                 if len(status['saved_files']) > 0:
                     st.write("Saved files:")
                     st.write([_ for _ in status['saved_files']])
+                if 'unchanged_entities' in status:
+                    st.write(f"{len(status['unchanged_entities'])} entities unchanged, not exported.")
+                if status.get('chunks'):
+                    st.write("Predicted cost per file:")
+                    st.dataframe(pd.DataFrame(status['chunks']))
                 if len(status['added_entities']) > 0:
                     st.write("Added entities:")
                     st.write([_ for _ in status['added_entities']])
+                show_performance(status)
     if helper_option=="Export Virtual Entity Config":
         file_export_path = st.text_input("File Export Path")
         building_config_file = st.file_uploader("Building Config", type=None, accept_multiple_files=False, key=None, help=None, on_change=None)
@@ -102,39 +141,20 @@ with tab_config_exporter:
         abel_config = None
         building_config = None
 
-        save_folder = "files"
-
-        if not os.path.exists(save_folder):
-            os.makedirs(save_folder)
-
         if building_config_file:
-            building_config_bytes = building_config_file.read()
-            building_config_bytes = building_config_bytes.decode("UTF-8")
-
-            with open(f"{save_folder}/{building_config_file.name}", "w") as f:
-                f.write(building_config_bytes)
-
-            with open(f"{save_folder}/{building_config_file.name}", 'r') as f:
-                building_config = yaml.load(f)
-                f.close()
-            os.remove(f"{save_folder}/{building_config_file.name}")
+            building_config = get_config_cache().load(building_config_file.getvalue(), BuildingConfig, loader='safe')
 
-        if abel_config_file:     
-            abel_config_bytes = abel_config_file.read()
-            abel_config_bytes = abel_config_bytes.decode("UTF-8")
+        if abel_config_file:
+            abel_config = get_config_cache().load(abel_config_file.getvalue(), AbelConfig, loader='rt')
 
-            with open(f"{save_folder}/{abel_config_file.name}", "w") as f:
-                f.write(abel_config_bytes)
-
-            with open(f"{save_folder}/{abel_config_file.name}", 'r') as f:
-                abel_config = yaml.load(f)
-                f.close()
-            os.remove(f"{save_folder}/{abel_config_file.name}")
+        if building_config and abel_config:
+            show_validation(validate_configs(building_config, abel_config, 'add-virtual', use_abel_flags))
 
         export = st.button("Export")
         if export:
             if building_config and abel_config and file_export_path:
-                status = export_add_config(building_config, abel_config, use_abel_flags, file_export_path)
+                status = export_add_config(building_config, abel_config, use_abel_flags, file_export_path,
+                                           perf=Instrumentation(trace_memory, trace_path or None))
 
                 if len(status['errors']) > 0:
                     st.write("Errors found:")
@@ -145,48 +165,36 @@ with tab_config_exporter:
                 if len(status['added_entities']) > 0:
                     st.write("Added entities:")
                     st.write([_ for _ in status['added_entities']])
+                show_performance(status)
 
     if helper_option=="Update Etags":
         file_export_path = st.text_input("File Export Path")
         building_config_file = st.file_uploader("Building Config", type=None, accept_multiple_files=False, key=None, help=None, on_change=None)
         abel_config_file = st.file_uploader("ABEL Config", type=None, accept_multiple_files=False, key=None, help=None, on_change=None)
+        only_changed_etags = st.checkbox("Only rewrite changed etags, keep the rest of the file as is", value=False)
+        stream_building_config = st.checkbox("Streaming building config ingestion (for very large exports, keeps only type, etag, code, translation and links)", value=False)
 
         abel_config = None
         building_config = None
 
-        save_folder = "files"
-
-        if not os.path.exists(save_folder):
-            os.makedirs(save_folder)
-
         if building_config_file:
-            building_config_bytes = building_config_file.read()
-            building_config_bytes = building_config_bytes.decode("UTF-8")
+            building_config = get_config_cache().load(building_config_file.getvalue(), BuildingConfig, loader='stream' if stream_building_config else 'safe')
 
-            with open(f"{save_folder}/{building_config_file.name}", "w") as f:
-                f.write(building_config_bytes)
+        if abel_config_file:
+            abel_config = get_config_cache().load(abel_config_file.getvalue(), AbelConfig, loader='rt')
 
-            with open(f"{save_folder}/{building_config_file.name}", 'r') as f:
-                building_config = yaml.load(f)
-                f.close()
-            os.remove(f"{save_folder}/{building_config_file.name}")
-
-        if abel_config_file:     
-            abel_config_bytes = abel_config_file.read()
-            abel_config_bytes = abel_config_bytes.decode("UTF-8")
-
-            with open(f"{save_folder}/{abel_config_file.name}", "w") as f:
-                f.write(abel_config_bytes)
-
-            with open(f"{save_folder}/{abel_config_file.name}", 'r') as f:
-                abel_config = yaml.load(f)
-                f.close()
-            os.remove(f"{save_folder}/{abel_config_file.name}")
+        if building_config and abel_config:
+            show_validation(validate_configs(building_config, abel_config, 'update-etags'))
 
         export = st.button("Export")
         if export:
             if building_config and abel_config:
-                status = update_etags(building_config, abel_config, file_export_path)
+                perf = Instrumentation(trace_memory, trace_path or None)
+                if only_changed_etags:
+                    status = update_etags_incremental(building_config, abel_config, abel_config_file.getvalue(), file_export_path, perf=perf)
+                    st.write(f"{len(status['changed_etags'])} etags changed.")
+                else:
+                    status = update_etags(building_config, abel_config, file_export_path, perf=perf)
 
                 if len(status['errors']) > 0:
                     st.write("Errors found:")
@@ -194,98 +202,121 @@ with tab_config_exporter:
                 if len(status['saved_files']) > 0:
                     st.write("Saved files:")
                     st.write([_ for _ in status['saved_files']])
+                show_performance(status)
+
+    if helper_option=="Bulk Export":
+        bulk_operation = st.selectbox("Exporter", ("update", "add-virtual", "update-etags"),
+                                      format_func={'update': "Reporting Entity Config", 'add-virtual': "Virtual Entity Config", 'update-etags': "Update Etags"}.get)
+        config_files = st.file_uploader("Building and ABEL Configs (yaml files or zip archives)", type=None, accept_multiple_files=True, key=None, help=None, on_change=None)
+        use_abel_flags = st.checkbox("Use 'operation' and 'update_mask' from ABEL config", value=True)
+        bulk_workers = st.number_input("Buildings exported at the same time", min_value=1, max_value=32, value=4)
+
+        pairs = []
+        if config_files:
+            pairs, errors = match_config_files(unpack_files({file.name: file.getvalue() for file in config_files}))
+            if len(errors) > 0:
+                st.write("Errors found:")
+                st.write([_ for _ in errors])
+            if len(pairs) > 0:
+                st.dataframe(pd.DataFrame(pairs, columns=['name', 'building_file', 'abel_file']))
+
+        export = st.button("Export all")
+        if export and pairs:
+            st.session_state['bulk_export'] = BulkExport(pairs, bulk_operation, bulk_workers, cache=get_config_cache(), abel_flags=use_abel_flags)
+
+        bulk_export = st.session_state.get('bulk_export')
+        if bulk_export is not None and not bulk_export.done:
+            show_bulk_progress(bulk_export)
+        elif bulk_export is not None:
+            results = bulk_export.results()
+            st.dataframe(pd.DataFrame([{
+                    'name': result['name'],
+                    'files': len(result['status']['saved_files']) if result['status'] else 0,
+                    'errors': len(result['status']['errors']) if result['status'] else 0,
+                    'validation errors': len(result['validation']['errors']) if result['validation'] else 0,
+                    'error': result['error']
+                    } for result in results]))
+            for result in results:
+                if result['status'] and len(result['status']['errors']) > 0:
+                    st.write(f"Errors found in {result['name']}:")
+                    st.write([_ for _ in result['status']['errors']])
+            st.download_button("Download exported configs", bulk_export.to_zip(), file_name='onboard_configs.zip', mime='application/zip')
 
 with tab_stubby:
 
     st.subheader('Stubby Commands')
     dbapi_option = st.selectbox(
         "Select operation",
-        ("Export Building Config", "Onboard Building"),
+        ("Export Building Config", "Onboard Building", "Onboard Exported Configs", "Check Operations"),
         index=None,
         placeholder="Select operation...",
     )
-    if dbapi_option=='Export Building Config':
+    building_code_input = None
+    if dbapi_option:
         building_code_input = st.text_input('Building Code')
         if building_code_input:
-            building_split = str.split(building_code_input.lower(), "-")
-            if len(building_split)==3:
-                building_country = building_split[0]
-                building_city = building_split[1]
-                building_code = building_split[2]
+            try:
+                building_name(building_code_input)
+            except ValueError as e:
+                st.write(str(e))
+                building_code_input = None
+
+    if dbapi_option=='Export Building Config':
         entity_guids_input = st.text_input('Guids (optional)')
+        entity_guids = None
         if entity_guids_input:
             entity_guids = re.sub(r"[, \n]+", ',', entity_guids_input)
             entity_guids = set(entity_guids.split(","))
-            entity_guids = ",".join(f"'{guid}'" for guid in entity_guids)
-        
-        if building_code_input:
-            if entity_guids_input:
-                st.code(
-                    f"""
-                    stubby call blade:google.cloud.digitalbuildings.v1alpha1.digitalbuildingsservice-prod google.cloud.digitalbuildings.v1alpha1.DigitalBuildingsService.ExportBuildingConfig --deadline=60000 --print_status_extensions --proto2 "name: 'projects/digitalbuildings/countries/{building_country}/cities/{building_city}/buildings/{building_code}', 
-                    profile:'projects/digitalbuildings/profiles/MaintenanceOps',instance_guid:[{entity_guids}]"
-                    """,
-                    wrap_lines=True
-                    )
-            else:
-                st.code(
-                    f"""
-                    stubby call blade:google.cloud.digitalbuildings.v1alpha1.digitalbuildingsservice-prod google.cloud.digitalbuildings.v1alpha1.DigitalBuildingsService.ExportBuildingConfig --deadline=60000 --print_status_extensions --proto2 "name: 'projects/digitalbuildings/countries/{building_country}/cities/{building_city}/buildings/{building_code}', profile:'projects/digitalbuildings/profiles/MaintenanceOps'"
-                    """,
-                    wrap_lines=True
-                    )
-
-        operation_input = st.text_input('Operation ID')
-        output_path_input = st.text_input('Output Path (optional)')
-        if operation_input:
-            if output_path_input:
-                st.code(
-                    f"""
-                    stubby call blade:google.cloud.digitalbuildings.v1alpha1.digitalbuildingsservice-prod google.cloud.digitalbuildings.v1alpha1.DigitalBuildingsService.GetOperation  --print_status_extensions --proto2 --outfile={output_path_input} --binary_output "name: 'projects/digitalbuildings/countries/{building_country}/cities/{building_city}/buildings/{building_code}', profile:'projects/digitalbuildings/profiles/MaintenanceOps', operation_name: '{operation_input}'"
-                    """,
-                    wrap_lines=True
-                    )
-            else:
-                st.code(
-                    f"""
-                    stubby call blade:google.cloud.digitalbuildings.v1alpha1.digitalbuildingsservice-prod google.cloud.digitalbuildings.v1alpha1.DigitalBuildingsService.GetOperation  --print_status_extensions --proto2 --binary_output "name: 'projects/digitalbuildings/countries/{building_country}/cities/{building_city}/buildings/{building_code}', profile:'projects/digitalbuildings/profiles/MaintenanceOps', operation_name: '{operation_input}'"
-                    """,
-                    wrap_lines=True
-                    )
 
-    if dbapi_option=='Onboard Building':
-        building_code_input = st.text_input('Building Code')
         if building_code_input:
-            building_split = str.split(building_code_input.lower(), "-")
-            if len(building_split)==3:
-                building_country = building_split[0]
-                building_city = building_split[1]
-                building_code = building_split[2]
+            st.code(export_building_config_command(building_code_input, entity_guids), wrap_lines=True)
 
+    if dbapi_option=='Onboard Building':
         config_input = st.text_input('Config Path')
-        
-        if building_code_input and config_input and len(building_split)==3:
-            st.code(
-                f"""
-                stubby call blade:google.cloud.digitalbuildings.v1alpha1.digitalbuildingsservice-prod google.cloud.digitalbuildings.v1alpha1.DigitalBuildingsService.OnboardBuilding --print_status_extensions --proto2 "name: 'projects/digitalbuildings/countries/{building_country}/cities/{building_city}/buildings/{building_code}', profile:'projects/digitalbuildings/profiles/MaintenanceOps'" --set_field "topology_file=readfile({config_input})"
-                """,
-                wrap_lines=True
-                )
 
+        if building_code_input and config_input:
+            st.code(onboard_building_command(building_code_input, config_input), wrap_lines=True)
+
+    if dbapi_option in ('Export Building Config', 'Onboard Building'):
         operation_input = st.text_input('Operation ID')
         output_path_input = st.text_input('Output Path (optional)')
-        if operation_input:
-            if output_path_input:
-                st.code(
-                    f"""
-                    stubby call blade:google.cloud.digitalbuildings.v1alpha1.digitalbuildingsservice-prod google.cloud.digitalbuildings.v1alpha1.DigitalBuildingsService.GetOperation  --print_status_extensions --proto2 --outfile={output_path_input} --binary_output "name: 'projects/digitalbuildings/countries/{building_country}/cities/{building_city}/buildings/{building_code}', profile:'projects/digitalbuildings/profiles/MaintenanceOps', operation_name: '{operation_input}'"
-                    """,
-                    wrap_lines=True
-                    )
+        if building_code_input and operation_input:
+            st.code(get_operation_command(building_code_input, operation_input, output_path_input or None), wrap_lines=True)
+
+    if dbapi_option=='Onboard Exported Configs':
+        dump_path_input = st.text_input('File Export Path used for the export')
+        log_path_input = st.text_input('Log File', value='onboard_operations.log')
+        if building_code_input and dump_path_input:
+            config_paths = exported_files(dump_path_input)
+            if config_paths:
+                script = onboard_script(building_code_input, config_paths, log_path_input)
+                st.write(f"{len(config_paths)} exported configs found.")
+                st.code(script, language='bash', wrap_lines=True)
+                st.download_button("Download script", script, file_name='onboard.sh', mime='text/x-shellscript')
             else:
-                st.code(
-                    f"""
-                    stubby call blade:google.cloud.digitalbuildings.v1alpha1.digitalbuildingsservice-prod google.cloud.digitalbuildings.v1alpha1.DigitalBuildingsService.GetOperation  --print_status_extensions --proto2 --binary_output "name: 'projects/digitalbuildings/countries/{building_country}/cities/{building_city}/buildings/{building_code}', profile:'projects/digitalbuildings/profiles/MaintenanceOps', operation_name: '{operation_input}'"
-                    """,
-                    wrap_lines=True
-                    )
+                st.write(f"No _ptN.yaml files found for {dump_path_input}.")
+
+    if dbapi_option=='Check Operations':
+        operations_input = st.text_area('Operation IDs or the log of the onboard script')
+        poll_timeout = st.number_input("Stop polling after (seconds)", min_value=10, value=600, step=60)
+        if building_code_input and operations_input:
+            operation_ids = parse_operation_ids(operations_input) or re.split(r"[, \n]+", operations_input.strip())
+            invalid_ids = [operation_id for operation_id in operation_ids if not OPERATION_ID_VALUE.fullmatch(operation_id)]
+            if invalid_ids:
+                st.write("Not valid operation IDs:")
+                st.write(invalid_ids)
+                operation_ids = [operation_id for operation_id in operation_ids if operation_id not in invalid_ids]
+            check = st.button("Check Operations")
+            if check and operation_ids:
+                st.session_state['operation_poll'] = OperationPoll(StubbyTransport(), building_code_input, operation_ids, timeout=poll_timeout)
+
+        operation_poll = st.session_state.get('operation_poll')
+        if operation_poll is not None and not operation_poll.done:
+            show_operations_progress(operation_poll)
+        elif operation_poll is not None:
+            results = operation_poll.results()
+            show_operation_states(results)
+            if operation_poll.error:
+                st.write(operation_poll.error)
+            failed = [result for result in results if result['error']]
+            st.write(f"{len(results)} operations, {len(failed)} failed or timed out.")
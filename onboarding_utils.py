@@ -1,201 +1,1884 @@
+import argparse
+import hashlib
+import hmac
+import io
+import json
+import os
+import pickle
+import posixpath
+import re
+import secrets
+import shutil
+import struct
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import zipfile
+from array import array
+from collections import OrderedDict, defaultdict
+from collections.abc import Mapping
+from contextlib import contextmanager
+from itertools import repeat
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
 import numpy as np
 import pandas as pd
 # import ruamel.yaml as yaml
 from ruamel.yaml import YAML
+from ruamel.yaml.comments import Comment, Format
+from ruamel.yaml.events import MappingEndEvent, MappingStartEvent, ScalarEvent, SequenceEndEvent, SequenceStartEvent
+from ruamel.yaml.nodes import MappingNode, ScalarNode, SequenceNode
+from ruamel.yaml.representer import RoundTripRepresenter
 
 yaml = YAML(typ='rt')
 
-def export_update_config(building_config, abel_config, abel_flags, dump_path, entity_list = None, max_items = 50):
+# Entity fields the exporters read from building config exports
+STREAM_FIELDS = ('type', 'etag', 'code', 'translation', 'links')
+
+
+def _compose_node(events, event, resolver):
     '''
-    Exports Onboard-Update config yaml. If there are more than 100 Entities to update, multiple config files will be exported to prevent DB API operation deadline errors.
+    Builds the node starting with event from the event stream.
+    '''
+    if isinstance(event, ScalarEvent):
+        tag = event.tag if event.tag not in (None, '!') else resolver.resolve(ScalarNode, event.value, event.implicit)
+        return ScalarNode(tag, event.value, style=event.style)
+    if isinstance(event, SequenceStartEvent):
+        items = []
+        for child in events:
+            if isinstance(child, SequenceEndEvent):
+                break
+            items.append(_compose_node(events, child, resolver))
+        tag = event.tag if event.tag not in (None, '!') else resolver.resolve(SequenceNode, None, event.implicit)
+        return SequenceNode(tag, items, flow_style=event.flow_style)
+    if isinstance(event, MappingStartEvent):
+        pairs = []
+        for child in events:
+            if isinstance(child, MappingEndEvent):
+                break
+            pairs.append((_compose_node(events, child, resolver), _compose_node(events, next(events), resolver)))
+        tag = event.tag if event.tag not in (None, '!') else resolver.resolve(MappingNode, None, event.implicit)
+        return MappingNode(tag, pairs, flow_style=event.flow_style)
+    raise ValueError(f'Unsupported yaml event in config: {event}')
+
+
+def iter_config(stream, fields=STREAM_FIELDS):
+    '''
+    Parses config one top-level entity at a time from the yaml event stream, the whole document is never built in memory.
     Args:
-        building_config_path: path to building config export
-        abel_config_path: path to ABEL config
-        dump_path: path to the new onboard-update yaml
-        entity_list: list of Entity Guids, if only need to export a config for select Entities. Default: None, all entities will be exported.
+        stream: open config file, or config contents as str/bytes
+        fields: entity fields to keep, other fields are dropped as soon as they are parsed. FACILITIES/BUILDING entity
+            is always kept whole. Default: STREAM_FIELDS, None keeps all fields.
+    Yields:
+        (guid, entity) pairs
     '''
-    MAX_ITEMS_PER_CONFIG = max_items
+    parser = YAML(typ='safe')
+    resolver = parser.resolver
+    constructor = parser.constructor
+    events = iter(parser.parse(stream))
 
-    new_abel_config = {}
-    if entity_list:
-        for key, val in abel_config.items():
-            if key in entity_list:
-                new_abel_config[key] = val
-        abel_config = new_abel_config.copy()
+    for event in events:
+        if isinstance(event, MappingStartEvent):
+            break
+    else:
+        return
 
-    config_top = {}
-    config_top['CONFIG_METADATA'] = {'operation': "UPDATE"}
-    building = [{key: val} for key, val in building_config.items() if val.get('type') and val['type']=='FACILITIES/BUILDING'][0]
-    config_top = config_top | building
+    for event in events:
+        if isinstance(event, MappingEndEvent):
+            break
+        guid = constructor.construct_document(_compose_node(events, event, resolver))
+        value_event = next(events)
+        if not isinstance(value_event, MappingStartEvent):
+            yield guid, constructor.construct_document(_compose_node(events, value_event, resolver))
+            continue
 
-    num_reporting_entities = len([key for key, val in abel_config.items() if 'translation' in val])
-    print(f'{num_reporting_entities} reporting entities found')
+        entity = {}
+        dropped = {}
+        for field_event in events:
+            if isinstance(field_event, MappingEndEvent):
+                break
+            field = constructor.construct_document(_compose_node(events, field_event, resolver))
+            node = _compose_node(events, next(events), resolver)
+            if fields is None or field in fields:
+                entity[field] = constructor.construct_document(node)
+            else:
+                dropped[field] = node
+        if dropped and entity.get('type') == 'FACILITIES/BUILDING':
+            entity |= {field: constructor.construct_document(node) for field, node in dropped.items()}
+        yield guid, entity
 
-    update_config = {}
-    entity_counter = 0
-    chunk_counter = 1
 
-    status = {
-            'errors': [],
-            'added_entities': [],
-            'saved_files': []
+class PartialConfig(dict):
+    '''
+    Config loaded with only some entity fields.
+    Attributes:
+        fields: entity fields kept, all other fields were dropped
+    '''
+    def __init__(self, entities, fields):
+        super().__init__(entities)
+        self.fields = tuple(fields)
+
+
+class StreamingLoader:
+    '''
+    Loader keeping only STREAM_FIELDS of every entity, for large building config exports.
+    '''
+    def __init__(self, fields=STREAM_FIELDS):
+        self.fields = fields
+
+    def load(self, stream):
+        if self.fields is None:
+            return dict(iter_config(stream, None))
+        return PartialConfig(iter_config(stream, self.fields), self.fields)
+
+
+class _EmptyMapping:
+    '''
+    Leaf value of an empty nested mapping in a TranslationTable.
+    '''
+
+
+class TranslationTable:
+    '''
+    Nested mappings (translations, links) of many entities in one shared, array-backed table. Every mapping is flattened
+    to (path id, value id) rows, paths of interned keys and leaf values are stored once however many entities use them.
+    Attributes:
+        paths: key tuple of every path id
+        values: leaf value of every value id
+        path_column, value_column: path and value id of every row
+    '''
+    def __init__(self):
+        self.paths = []
+        self.values = []
+        self.path_column = array('I')
+        self.value_column = array('I')
+        self._path_ids = {}
+        self._value_ids = {}
+
+    def _path_id(self, path):
+        path_id = self._path_ids.get(path)
+        if path_id is None:
+            path_id = self._path_ids[path] = len(self.paths)
+            self.paths.append(path)
+        return path_id
+
+    def _value_id(self, value):
+        if isinstance(value, list) and all(not isinstance(item, (Mapping, list)) for item in value):
+            value = tuple(value)
+        try:
+            key = (type(value), value)
+            value_id = self._value_ids.get(key)
+        except TypeError:
+            # unhashable leaves, e.g. lists of mappings, are stored as they are
+            self.values.append(value)
+            return len(self.values) - 1
+        if value_id is None:
+            value_id = self._value_ids[key] = len(self.values)
+            self.values.append(value)
+        return value_id
+
+    def _add(self, mapping, prefix):
+        for key, value in mapping.items():
+            path = prefix + (sys.intern(key) if isinstance(key, str) else key,)
+            if isinstance(value, Mapping) and value:
+                self._add(value, path)
+                continue
+            self.path_column.append(self._path_id(path))
+            self.value_column.append(self._value_id(_EmptyMapping if isinstance(value, Mapping) else value))
+
+    def add(self, mapping):
+        '''
+        Stores mapping, returns the range of its rows.
+        '''
+        start = len(self.path_column)
+        self._add(mapping, ())
+        return range(start, len(self.path_column))
+
+    def mapping(self, rows):
+        '''
+        Rebuilds the plain mapping stored in rows.
+        '''
+        result = {}
+        for row in rows:
+            path = self.paths[self.path_column[row]]
+            value = self.values[self.value_column[row]]
+            target = result
+            for key in path[:-1]:
+                target = target.setdefault(key, {})
+            target[path[-1]] = {} if value is _EmptyMapping else list(value) if isinstance(value, tuple) else value
+        return result
+
+
+class EntityRecord(Mapping):
+    '''
+    Compact read-only entity. Field names are a tuple shared by all entities with the same fields, nested mappings
+    are rows of the config's TranslationTable and are rebuilt as plain dicts when read.
+    '''
+    __slots__ = ('_fields', '_values', '_table')
+
+    def __init__(self, fields, values, table):
+        self._fields = fields
+        self._values = values
+        self._table = table
+
+    def __getitem__(self, field):
+        try:
+            value = self._values[self._fields.index(field)]
+        except ValueError:
+            raise KeyError(field) from None
+        if isinstance(value, range):
+            return self._table.mapping(value)
+        if isinstance(value, tuple):
+            return list(value)
+        return value
+
+    def __iter__(self):
+        return iter(self._fields)
+
+    def __len__(self):
+        return len(self._fields)
+
+    def __contains__(self, field):
+        return field in self._fields
+
+    def filled(self, field):
+        '''
+        True if field is set to a non-empty value, like bool(self.get(field)) without rebuilding nested mappings.
+        '''
+        try:
+            return bool(self._values[self._fields.index(field)])
+        except ValueError:
+            return False
+
+    def to_dict(self):
+        '''
+        Plain dict copy of the entity.
+        '''
+        return {field: self[field] for field in self._fields}
+
+    def __reduce__(self):
+        # pickled on its own, e.g. for exporter worker processes, the entity is sent as a plain dict
+        return dict, (self.to_dict(),)
+
+    def __repr__(self):
+        return f'{type(self).__name__}({self.to_dict()!r})'
+
+
+RoundTripRepresenter.add_representer(EntityRecord, RoundTripRepresenter.represent_dict)
+
+# Scalar fields of every entity interned so that repeated values share one string
+INTERNED_FIELDS = ('type', 'code', 'operation')
+
+
+class CompactConfig(Mapping):
+    '''
+    Config held as EntityRecords sharing one TranslationTable, a fraction of the memory of ruamel.yaml mappings.
+    Comments and styling of the source are not kept, entities are emitted as plain mappings.
+    Args:
+        entities: mapping or iterable of (guid, entity) pairs
+    '''
+    def __init__(self, entities=()):
+        self.table = TranslationTable()
+        self.records = {}
+        self._layouts = {}
+        for guid, entity in (entities.items() if isinstance(entities, Mapping) else entities):
+            self.add(guid, entity)
+
+    def _compact(self, field, value):
+        if isinstance(value, Mapping):
+            return self.table.add(value)
+        if isinstance(value, list) and all(isinstance(item, str) for item in value):
+            return tuple(sys.intern(item) for item in value)
+        if field in INTERNED_FIELDS and isinstance(value, str):
+            return sys.intern(value)
+        return value
+
+    def add(self, guid, entity):
+        if not isinstance(entity, Mapping):
+            self.records[guid] = entity
+            return
+        fields = tuple(sys.intern(field) if isinstance(field, str) else field for field in entity)
+        fields = self._layouts.setdefault(fields, fields)
+        self.records[guid] = EntityRecord(fields, tuple(self._compact(field, entity[field]) for field in fields), self.table)
+
+    def __getitem__(self, guid):
+        return self.records[guid]
+
+    def __iter__(self):
+        return iter(self.records)
+
+    def __len__(self):
+        return len(self.records)
+
+    def __contains__(self, guid):
+        return guid in self.records
+
+    def to_dict(self):
+        '''
+        Plain dict copy of the config.
+        '''
+        return {guid: record.to_dict() if isinstance(record, EntityRecord) else record for guid, record in self.records.items()}
+
+    def __getstate__(self):
+        records = [(guid, record._fields, record._values) if isinstance(record, EntityRecord) else (guid, None, record)
+                   for guid, record in self.records.items()]
+        return {'table': self.table, 'records': records}
+
+    def __setstate__(self, state):
+        self.table = state['table']
+        self.records = {}
+        self._layouts = {}
+        for guid, fields, values in state['records']:
+            if fields is None:
+                self.records[guid] = values
+                continue
+            fields = self._layouts.setdefault(fields, fields)
+            self.records[guid] = EntityRecord(fields, values, self.table)
+
+
+class CompactLoader:
+    '''
+    Loader building a CompactConfig entity by entity, the whole document is never held as yaml mappings.
+    '''
+    def load(self, stream):
+        return CompactConfig(iter_config(stream, fields=None))
+
+
+# Loader factories by name. 'safe' uses the C-backed parser when ruamel.yaml.clib is installed
+# and builds plain dicts/lists, 'rt' keeps comments and styling for documents that are re-emitted,
+# 'compact' holds large configs as EntityRecords.
+LOADERS = {
+    'safe': lambda: YAML(typ='safe'),
+    'rt': lambda: YAML(typ='rt'),
+    'stream': StreamingLoader,
+    'compact': CompactLoader,
+}
+
+def register_loader(name, factory):
+    '''
+    Registers a config loader.
+    Args:
+        name: loader name to use in load_config
+        factory: callable returning an object with a load(stream) method
+    '''
+    LOADERS[name] = factory
+
+
+def load_config(source, loader='safe'):
+    '''
+    Loads building/ABEL config.
+    Args:
+        source: path to the config file, open file, or config contents as bytes/multi-line str
+        loader: name of the loader in LOADERS. Default: 'safe', use 'rt' only for configs that are dumped back as a whole (e.g. onboard config in update_etags).
+    '''
+    if loader not in LOADERS:
+        raise ValueError(f"Unknown loader: {loader}. Available loaders: {', '.join(LOADERS)}")
+    parser = LOADERS[loader]()
+    if isinstance(source, os.PathLike) or (isinstance(source, str) and '\n' not in source):
+        with open(source, 'r') as f:
+            return parser.load(f)
+    return parser.load(source)
+
+
+SNAPSHOT_MAGIC = b'ONBOARD-SNAPSHOT-2\n'
+
+# Key snapshots are signed with, readable by the current user only. Snapshots signed with another key are not loaded.
+SNAPSHOT_KEY_PATH = os.environ.get('ONBOARD_SNAPSHOT_KEY', os.path.join(os.path.expanduser('~'), '.onboard_snapshot_key'))
+
+
+def _snapshot_path(source_path, loader):
+    return f'{source_path}.{loader}.snapshot'
+
+
+def _snapshot_key():
+    '''
+    Reads the snapshot signing key, creates it on first use.
+    '''
+    try:
+        fd = os.open(SNAPSHOT_KEY_PATH, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        with open(SNAPSHOT_KEY_PATH, 'rb') as f:
+            return f.read()
+    key = secrets.token_bytes(32)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(key)
+    return key
+
+
+def _file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(2**20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def save_snapshot(config, source_path, loader='safe'):
+    '''
+    Saves parsed config to a binary snapshot next to the source file: header with the source mtime, size and
+    SHA-256, HMAC-SHA256 of header and payload with the local snapshot key, then the pickled config.
+    Args:
+        config: parsed config, as returned by load_config
+        source_path: path to the config file the config was parsed from
+        loader: name of the loader the config was parsed with
+    '''
+    source_stat = os.stat(source_path)
+    header = json.dumps({
+            'loader': loader,
+            'mtime_ns': source_stat.st_mtime_ns,
+            'size': source_stat.st_size,
+            'sha256': _file_sha256(source_path)
+            }).encode('UTF-8')
+    payload = pickle.dumps(config, protocol=pickle.HIGHEST_PROTOCOL)
+    signature = hmac.new(_snapshot_key(), header, hashlib.sha256)
+    signature.update(payload)
+    snapshot_path = _snapshot_path(source_path, loader)
+    with open(f'{snapshot_path}.tmp', 'wb') as f:
+        f.write(SNAPSHOT_MAGIC)
+        f.write(struct.pack('<I', len(header)))
+        f.write(header)
+        f.write(signature.digest())
+        f.write(payload)
+    os.replace(f'{snapshot_path}.tmp', snapshot_path)
+    return snapshot_path
+
+
+def load_snapshot(source_path, loader='safe'):
+    '''
+    Loads config from its binary snapshot. Snapshots are pickles, they are only unpickled if they are signed
+    with the local snapshot key, i.e. saved by save_snapshot for the same user.
+    Args:
+        source_path: path to the config file
+        loader: name of the loader the snapshot was saved for
+    Returns:
+        parsed config, or None if there is no valid snapshot, it can't be unpickled or the source changed since it was saved
+    '''
+    snapshot_path = _snapshot_path(source_path, loader)
+    if not os.path.isfile(snapshot_path):
+        return None
+    with open(snapshot_path, 'rb') as f:
+        snapshot = f.read()
+    header_start = len(SNAPSHOT_MAGIC) + 4
+    if len(snapshot) < header_start or snapshot[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+        return None
+    header_size, = struct.unpack('<I', snapshot[len(SNAPSHOT_MAGIC):header_start])
+    signature_start = header_start + header_size
+    payload_start = signature_start + hashlib.sha256().digest_size
+    if len(snapshot) < payload_start:
+        return None
+
+    with memoryview(snapshot) as data:
+        signature = hmac.new(_snapshot_key(), data[header_start:signature_start], hashlib.sha256)
+        signature.update(data[payload_start:])
+        if not hmac.compare_digest(signature.digest(), data[signature_start:payload_start]):
+            return None
+        header = json.loads(data[header_start:signature_start].tobytes())
+
+        source_stat = os.stat(source_path)
+        if header['loader'] != loader or header['size'] != source_stat.st_size:
+            return None
+        # same size but touched since the snapshot was saved, compare contents
+        if header['mtime_ns'] != source_stat.st_mtime_ns and header['sha256'] != _file_sha256(source_path):
+            return None
+        try:
+            return pickle.loads(data[payload_start:])
+        except (AttributeError, ImportError, EOFError, pickle.UnpicklingError):
+            # classes of the pickled config moved or were renamed, e.g. snapshots saved by code run as __main__
+            return None
+
+
+def load_config_snapshot(source_path, loader='safe'):
+    '''
+    Loads config from its binary snapshot if the source did not change, otherwise parses the source and saves a new snapshot.
+    Args:
+        source_path: path to the config file
+        loader: name of the loader in LOADERS
+    '''
+    config = load_snapshot(source_path, loader)
+    if config is None:
+        config = load_config(source_path, loader=loader)
+        save_snapshot(config, source_path, loader)
+    return config
+
+
+class ConfigCache:
+    '''
+    LRU cache of parsed configs keyed by SHA-256 of the config contents.
+    Cached configs are shared, the exporters do not modify them.
+    Args:
+        max_entries: max number of parsed configs to keep
+    '''
+    def __init__(self, max_entries=8):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def load(self, data, config_cls=None, loader='safe'):
+        '''
+        Returns parsed config for data, parses it only if it is not cached yet.
+        Args:
+            data: config contents as bytes
+            config_cls: Config subclass to wrap the parsed config in. Default: None, parsed config is returned as is.
+            loader: name of the loader in LOADERS
+        '''
+        key = (hashlib.sha256(data).hexdigest(), loader, config_cls)
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+
+        config = load_config(data, loader=loader)
+        if config_cls is not None:
+            config = config_cls(config)
+
+        with self._lock:
+            self._entries[key] = config
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return config
+
+
+class Config(Mapping):
+    '''
+    Read-only view over a loaded building/ABEL config with indexes built in a single pass.
+    Args:
+        entities: loaded config, mapping of guid to entity
+    Attributes:
+        by_type: entity type to list of guids
+        by_code: entity code to guid
+        reporting: guids of entities with translation, in config order
+        virtual: guids of entities with links, in config order
+        fields: entity fields kept by the loader, None if entities were loaded whole
+    '''
+    def __init__(self, entities):
+        self.entities = entities or {}
+        self.fields = getattr(entities, 'fields', None)
+        self.by_type = defaultdict(list)
+        self.by_code = {}
+        self.reporting = []
+        self.virtual = []
+        for guid, entity in self.entities.items():
+            if not isinstance(entity, Mapping):
+                continue
+            # translation and links of compact records are only checked, not rebuilt
+            filled = entity.filled if isinstance(entity, EntityRecord) else entity.get
+            if entity.get('type'):
+                self.by_type[entity['type']].append(guid)
+            if entity.get('code'):
+                self.by_code.setdefault(entity['code'], guid)
+            if filled('translation'):
+                self.reporting.append(guid)
+            if filled('links'):
+                self.virtual.append(guid)
+
+    def __getitem__(self, guid):
+        return self.entities[guid]
+
+    def __iter__(self):
+        return iter(self.entities)
+
+    def __len__(self):
+        return len(self.entities)
+
+    def __contains__(self, guid):
+        return guid in self.entities
+
+    @classmethod
+    def wrap(cls, config):
+        '''
+        Returns config as is if it is already indexed, otherwise builds the indexes.
+        '''
+        return config if isinstance(config, cls) else cls(config)
+
+
+class BuildingConfig(Config):
+    '''
+    Indexed building config export.
+    '''
+    @property
+    def building(self):
+        '''
+        {guid: entity} of the FACILITIES/BUILDING entity.
+        '''
+        if not self.by_type.get('FACILITIES/BUILDING'):
+            raise ValueError('FACILITIES/BUILDING entity not found in building config.')
+        guid = self.by_type['FACILITIES/BUILDING'][0]
+        return {guid: self.entities[guid]}
+
+
+class AbelConfig(Config):
+    '''
+    Indexed ABEL config.
+    '''
+
+
+class EntityView(Mapping):
+    '''
+    Read-only view of a config entity with fields added, replaced or left out. The entity is neither copied nor modified,
+    so loaded configs can be shared by exports running at the same time.
+    Args:
+        entity: source entity
+        head: fields put before the entity fields, the entity values win if it has them
+        overrides: fields replacing entity fields in place, or added after them
+        removed: fields left out
+        keep_format: dump with the flow style and comments of a round-trip loaded entity, like a copy of it
+    '''
+    __slots__ = ('_entity', '_head', '_overrides', '_removed', '_keep_format')
+    # attributes the ruamel.yaml representer reads from round-trip loaded mappings
+    FORMAT_ATTRIBUTES = ('fa', 'ca', 'tag', 'yaml_anchor', Comment.attrib, Format.attrib)
+
+    def __init__(self, entity, head=None, overrides=None, removed=(), keep_format=False):
+        self._entity = entity
+        self._head = {} if head is None else head
+        self._overrides = {} if overrides is None else overrides
+        self._removed = removed
+        self._keep_format = keep_format
+
+    def __getitem__(self, key):
+        if key in self._removed:
+            raise KeyError(key)
+        if key in self._overrides:
+            return self._overrides[key]
+        if key in self._entity:
+            return self._entity[key]
+        return self._head[key]
+
+    def __iter__(self):
+        for key in self._head:
+            if key not in self._removed:
+                yield key
+        for key in self._entity:
+            if key not in self._head and key not in self._removed:
+                yield key
+        for key in self._overrides:
+            if key not in self._head and key not in self._entity and key not in self._removed:
+                yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __contains__(self, key):
+        return key not in self._removed and (key in self._overrides or key in self._entity or key in self._head)
+
+    def __getattr__(self, name):
+        if name in EntityView.FORMAT_ATTRIBUTES and self._keep_format:
+            return getattr(self._entity, name)
+        raise AttributeError(name)
+
+    def __repr__(self):
+        return f'{type(self).__name__}({dict(self)!r})'
+
+
+RoundTripRepresenter.add_representer(EntityView, RoundTripRepresenter.represent_dict)
+
+
+def merged_items(*mappings):
+    '''
+    Yields (key, value) pairs of the mappings merged like dict union: keys in order of first appearance, values from the last mapping.
+    '''
+    seen = set()
+    for idx, mapping in enumerate(mappings):
+        for key in mapping:
+            if key in seen:
+                continue
+            seen.add(key)
+            yield key, next(later[key] for later in reversed(mappings[idx:]) if key in later)
+
+
+class Instrumentation:
+    '''
+    Stage timers, counters and traced memory peaks of an exporter call.
+    Stage times are exclusive: time spent in a nested stage is only counted for the nested stage.
+    Used as a context manager, memory tracing is stopped and the trace file saved even if the call fails.
+    Args:
+        trace_memory: record tracemalloc peak per stage. Slows down allocation-heavy stages.
+        trace_path: path to save the report to as JSON when finished
+    '''
+    def __init__(self, trace_memory=False, trace_path=None):
+        self.trace_memory = trace_memory
+        self.trace_path = trace_path
+        self.stages = {}
+        self.counters = defaultdict(int)
+        self.peaks = {}
+        self._stack = []
+        self._started_tracemalloc = False
+        self._finished = False
+        self._start = self._mark = time.perf_counter()
+
+    def _switch(self):
+        # time and memory peak since the last stage change belong to the current stage
+        now = time.perf_counter()
+        tracing = self.trace_memory and tracemalloc.is_tracing()
+        if self._stack:
+            name = self._stack[-1]
+            self.stages[name] = self.stages.get(name, 0.0) + now - self._mark
+            if tracing:
+                self.peaks[name] = max(self.peaks.get(name, 0), tracemalloc.get_traced_memory()[1])
+        if tracing:
+            tracemalloc.reset_peak()
+        self._mark = now
+
+    @contextmanager
+    def stage(self, name):
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracemalloc = True
+        self._switch()
+        self._stack.append(name)
+        try:
+            yield
+        finally:
+            self._switch()
+            self._stack.pop()
+
+    def count(self, name, value=1):
+        self.counters[name] += value
+
+    def count_file(self, file_path):
+        self.count('files')
+        self.count('bytes_written', os.path.getsize(file_path))
+
+    def report(self):
+        report = {
+                'total_seconds': round(time.perf_counter() - self._start, 4),
+                'stages': {name: round(seconds, 4) for name, seconds in self.stages.items()},
+                'counters': dict(self.counters)
+                }
+        if self.trace_memory:
+            report['peak_memory_mb'] = {name: round(peak / 2**20, 2) for name, peak in self.peaks.items()}
+        return report
+
+    def finish(self):
+        '''
+        Stops memory tracing started by this instance, saves the trace file and returns the report.
+        '''
+        if self._started_tracemalloc:
+            tracemalloc.stop()
+            self._started_tracemalloc = False
+        self._finished = True
+        report = self.report()
+        if self.trace_path:
+            with open(self.trace_path, 'w') as f:
+                json.dump(report, f, indent=2)
+        return report
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        if not self._finished:
+            self.finish()
+
+
+class ConfigWriter:
+    '''
+    Streams config entities to a yaml file. One serializer is used for the whole file, the output is the same as
+    yaml.dump({key: value}) followed by an empty line for every entity. Comments and flow style are only kept for
+    entities loaded with the 'rt' loader, entities from the 'safe' loaded building config are written in block style.
+    Args:
+        file_path: path to the new yaml, or an open text stream to write to. Streams are not closed by the writer.
+        perf: Instrumentation to record emit time and written entities and bytes in
+    '''
+    def __init__(self, file_path, perf=None):
+        self.perf = perf
+        if hasattr(file_path, 'write'):
+            self.file_path = None
+            self._file = file_path
+        else:
+            self.file_path = file_path
+            self._file = open(file_path, 'w')
+        self._closed = False
+        self._yaml = YAML(typ='rt')
+        self._yaml.get_serializer_representer_emitter(self._file, None)
+        self._yaml.serializer.open()
+
+    def write(self, key, value, count=True):
+        '''
+        Writes one entity. count: count it in 'entities_written', False for CONFIG_METADATA and the building entity.
+        '''
+        if self.perf is not None:
+            with self.perf.stage('emit'):
+                self._write(key, value)
+            if count:
+                self.perf.count('entities_written')
+        else:
+            self._write(key, value)
+
+    def _write(self, key, value):
+        self._yaml.representer.represent({key: value})
+        self._file.write('\n')
+        # every entity is its own document, skip the '---' separator the emitter adds to all but the first one.
+        # Emitter state is private to ruamel.yaml: keep requirements.txt pinned to versions test_onboarding_utils.py passes with
+        self._yaml.emitter.state = self._yaml.emitter.expect_first_document_start
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            self._yaml.serializer.close()
+            self._yaml.emitter.dispose()
+        finally:
+            if self.file_path is not None:
+                self._file.close()
+                if self.perf is not None:
+                    self.perf.count_file(self.file_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def write_config(file_path, entities, perf=None, header=None):
+    '''
+    Writes config entities to a yaml file.
+    Args:
+        file_path: path to the new yaml, or an open text stream
+        entities: iterable of (guid, entity) pairs
+        perf: Instrumentation to record emit time and written entities and bytes in
+        header: mapping written before the entities and not counted as written entities, e.g. CONFIG_METADATA and the building entity
+    '''
+    with ConfigWriter(file_path, perf) as writer:
+        for key, value in (header or {}).items():
+            writer.write(key, value, count=False)
+        for key, value in entities:
+            writer.write(key, value)
+    return file_path
+
+
+def render_entities(entities, perf=None):
+    '''
+    Yields (guid, entity, yaml) for every entity, yaml is the text ConfigWriter writes for it.
+    Args:
+        entities: iterable of (guid, entity) pairs
+        perf: Instrumentation to record emit time in
+    '''
+    buffer = io.StringIO()
+    with ConfigWriter(buffer, perf) as writer:
+        for key, value in entities:
+            writer.write(key, value)
+            yield key, value, buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+
+
+def entity_cost(entity, text):
+    '''
+    Predicted payload cost of an entity in an OnboardBuilding operation.
+    Args:
+        entity: config entity
+        text: entity yaml
+    Returns:
+        dict with serialized size in bytes and number of translated fields
+    '''
+    translation = entity.get('translation')
+    return {
+            'bytes': len(text.encode('UTF-8')),
+            'fields': max(len(translation), 1) if isinstance(translation, Mapping) else 1
             }
 
-    for idx, items in enumerate(abel_config.items()):
-        key = items[0]
-        val = items[1]
 
-        if val.get('translation'):
+def plan_chunks(costs, max_bytes=None, max_fields=None, max_items=None):
+    '''
+    Packs entities into as few chunks as possible without exceeding the budgets (first fit decreasing).
+    An entity over a budget on its own gets a chunk of its own.
+    Args:
+        costs: list of entity_cost dicts
+        max_bytes: max serialized size of the entities in a chunk. Default: None, no limit.
+        max_fields: max number of translated fields in a chunk. Default: None, no limit.
+        max_items: max number of entities in a chunk. Default: None, no limit.
+    Returns:
+        list of lists of indexes into costs, in chunk order, indexes are sorted within a chunk
+    '''
+    budgets = {'bytes': max_bytes or float('inf'), 'fields': max_fields or float('inf'), 'items': max_items or float('inf')}
+
+    def weight(idx):
+        return max(costs[idx]['bytes'] / budgets['bytes'], costs[idx]['fields'] / budgets['fields'])
+
+    # biggest entities first, config order for equal weights keeps the plan deterministic
+    order = sorted(range(len(costs)), key=lambda idx: (-weight(idx), idx))
+    smallest_bytes = min((cost['bytes'] for cost in costs), default=0)
+    smallest_fields = min((cost['fields'] for cost in costs), default=0)
+
+    chunks = []
+    open_chunks = []
+    for idx in order:
+        cost = costs[idx]
+        for chunk in open_chunks:
+            if chunk['bytes'] + cost['bytes'] <= budgets['bytes'] and chunk['fields'] + cost['fields'] <= budgets['fields'] \
+                    and len(chunk['entities']) < budgets['items']:
+                break
+        else:
+            chunk = {'entities': [], 'bytes': 0, 'fields': 0}
+            chunks.append(chunk)
+            open_chunks.append(chunk)
+        chunk['entities'].append(idx)
+        chunk['bytes'] += cost['bytes']
+        chunk['fields'] += cost['fields']
+        if chunk['bytes'] + smallest_bytes > budgets['bytes'] or chunk['fields'] + smallest_fields > budgets['fields'] \
+                or len(chunk['entities']) >= budgets['items']:
+            open_chunks.remove(chunk)
+    return [sorted(chunk['entities']) for chunk in chunks]
+
+
+def _normalized(value):
+    '''
+    Plain copy of a config value for comparison, scalars are compared as strings so values parsed by different loaders match.
+    '''
+    if isinstance(value, Mapping):
+        return {str(key): _normalized(val) for key, val in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_normalized(val) for val in value]
+    return value if value is None else str(value)
+
+
+def changed_fields(entity, building_entity, fields):
+    '''
+    Returns the fields whose value in entity differs from building_entity, in the order of fields.
+    A field missing from one entity and present in the other is changed.
+    '''
+    return [field for field in fields if _normalized(entity.get(field)) != _normalized(building_entity.get(field))]
 
-            if key in building_config.keys():
+
+def _not_in_building_config(guid, entity=None):
+    '''
+    Error for an entity missing from the building config, with the entity code if entity is given.
+    '''
+    if entity is None:
+        return f'Not in building config: {guid}'
+    return f"Not in building config: {guid}, {entity.get('code')}"
+
+
+def _no_etag(guid, entity):
+    '''
+    Error for an entity without etag in the building config.
+    '''
+    return f"No etag for: {guid}, {entity.get('code')}"
+
+
+def _updates_etag(guid, entity):
+    '''
+    True for the onboard config entities update_etags sets the etag of: entities with translation or an UPDATE operation.
+    '''
+    return guid != 'CONFIG_METADATA' and any([entity.get('operation') and entity.get('operation').lower()=='update',
+                                              entity.get('translation')])
+
+
+def _update_entities(building_config, abel_config, guids, abel_flags, status, perf, delta=False):
+    '''
+    Yields (guid, entity) pairs to export.
+    Errors and added entities are recorded in status as the ABEL config is visited.
+    If delta, entities equal to the building config in all masked fields are skipped and recorded in status['unchanged_entities'].
+    '''
+    for key in guids:
+        with perf.stage('merge'):
+            entity = abel_config[key]
+
+            if key in building_config:
 
                 if building_config[key].get('etag'):
                     etag = str(building_config[key].get('etag'))
                 else: etag = 'MISSING ETAG'
 
+                # loaded configs may be cached and shared, changed fields are overlaid on the ABEL entity
+                overrides = {}
                 if not abel_flags:
-                    val['operation'] =  'UPDATE'
-                    val['update_mask'] = ['type', 'translation']
+                    overrides['operation'] =  'UPDATE'
+                    overrides['update_mask'] = ['type', 'translation']
+
+                update_mask = overrides.get('update_mask', entity.get('update_mask'))
+                if update_mask and isinstance(update_mask, list):
+                    overrides['update_mask'] = [i.lower() for i in update_mask]
 
-                if val.get('update_mask') and isinstance(val['update_mask'], list):
-                    val['update_mask'] = [i.lower() for i in val['update_mask']]
+                if delta:
+                    # without a mask all fields of the ABEL entity are updated
+                    if isinstance(overrides.get('update_mask'), list):
+                        fields = overrides['update_mask']
+                    else:
+                        fields = [field for field in entity if field not in ('etag', 'operation', 'update_mask')]
+                        if building_config.fields is not None:
+                            # fields the loader dropped can't be compared, they would always look changed
+                            fields = [field for field in fields if field in building_config.fields]
+                    changed = changed_fields(entity, building_config[key], fields)
+                    if not changed:
+                        status['unchanged_entities'].append(key)
+                        continue
+                    overrides['update_mask'] = changed
 
-                update_config[key] = {'etag': etag} \
-                                | val
+                val = EntityView(entity, head={'etag': etag}, overrides=overrides)
 
                 status['added_entities'].append(key)
-                entity_counter += 1
-            else: status['errors'].append(f'Not in building config: {key}')
-        else: pass
+            else:
+                status['errors'].append(_not_in_building_config(key))
+                continue
+        yield key, val
 
-        if entity_counter!=0 and any([entity_counter%MAX_ITEMS_PER_CONFIG==0, idx==len(abel_config.keys())-1]):
-            
-            new_file_name = dump_path.replace('.yaml', f'_pt{chunk_counter}.yaml')
-            update_config = config_top | update_config
 
-            with open(new_file_name, 'w') as f:
-                for key, value in update_config.items():
-                    yaml.dump({key: value}, f)
-                    f.write('\n')
-                f.close()
-            status['saved_files'].append(f"{entity_counter} entities saved in {new_file_name}.")
+def _chunk_by_count(entities, max_items):
+    '''
+    Yields lists of max_items (guid, entity) pairs.
+    '''
+    chunk = []
+    for entity in entities:
+        chunk.append(entity)
+        if len(chunk)==max_items:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def export_update_config(building_config, abel_config, abel_flags, dump_path, entity_list = None, max_items = 50, workers = None,
+                         max_bytes = None, max_fields = None, delta = False, perf = None):
+    '''
+    Exports Onboard-Update config yaml. If there are more than 100 Entities to update, multiple config files will be exported to prevent DB API operation deadline errors.
+    Args:
+        building_config_path: path to building config export
+        abel_config_path: path to ABEL config
+        dump_path: path to the new onboard-update yaml
+        entity_list: list of Entity Guids, if only need to export a config for select Entities. Default: None, all entities will be exported.
+        workers: number of processes to write the _ptN.yaml files with. Default: None, files are written one by one as the ABEL config is visited.
+        max_bytes: max size of the entities in one file. If max_bytes or max_fields is set, entities are packed into as few files as
+            possible within the budgets and max_items, and status['chunks'] has the predicted cost of every file.
+        max_fields: max number of translated fields in one file.
+            With budgets, the yaml of all entities is rendered and held in memory before the first file is written,
+            and workers can't be used.
+        delta: only export entities that differ from the building config in their masked fields (type and translation without ABEL flags),
+            with update_mask narrowed to the changed fields. Skipped entities are listed in status['unchanged_entities'].
+            Entities without update_mask are compared in all fields, or only in the fields kept if the building config
+            was loaded with the 'stream' loader. Masked fields the loader dropped are always exported.
+        perf: Instrumentation to record stage timings in, the report is returned in status['performance']
+    '''
+    if workers and workers > 1 and (max_bytes or max_fields):
+        raise ValueError("workers can't be used with max_bytes or max_fields, budgeted files are written from rendered entities.")
+    MAX_ITEMS_PER_CONFIG = max_items
+    perf = perf or Instrumentation()
+    with perf:
+
+        with perf.stage('index'):
+            building_config = BuildingConfig.wrap(building_config)
+            abel_config = AbelConfig.wrap(abel_config)
+
+        with perf.stage('filter'):
+            reporting_guids = abel_config.reporting
+            if entity_list:
+                entity_set = set(entity_list)
+                reporting_guids = [key for key in reporting_guids if key in entity_set]
+
+            config_top = {}
+            config_top['CONFIG_METADATA'] = {'operation': "UPDATE"}
+            config_top = config_top | building_config.building
 
-            update_config = {}
-            chunk_counter += 1
-            entity_counter = 0
-        else: pass
-    return status
+        print(f'{len(reporting_guids)} reporting entities found')
 
+        status = {
+                'errors': [],
+                'added_entities': [],
+                'saved_files': []
+                }
+        if delta:
+            status['unchanged_entities'] = []
 
-def export_add_config(building_config, abel_config, abel_flags, dump_path):
+        entities = _update_entities(building_config, abel_config, reporting_guids, abel_flags, status, perf, delta)
+
+        if max_bytes or max_fields:
+            # entities are rendered once, their yaml is used both for the cost estimate and the exported files
+            rendered = [(key, text, entity_cost(val, text)) for key, val, text in render_entities(entities, perf)]
+            top_text = write_config(io.StringIO(), (), perf, header=config_top).getvalue()
+            top_bytes = len(top_text.encode('UTF-8'))
+            with perf.stage('plan'):
+                plan = plan_chunks([cost for _, _, cost in rendered], max(max_bytes - top_bytes, 1) if max_bytes else None, max_fields, MAX_ITEMS_PER_CONFIG)
+
+            status['chunks'] = []
+            for chunk_counter, chunk in enumerate(plan, start=1):
+                file_name = dump_path.replace('.yaml', f'_pt{chunk_counter}.yaml')
+                with perf.stage('emit'):
+                    with open(file_name, 'w') as f:
+                        f.write(top_text)
+                        f.writelines(rendered[idx][1] for idx in chunk)
+                perf.count_file(file_name)
+                status['saved_files'].append(f"{len(chunk)} entities saved in {file_name}.")
+                status['chunks'].append({
+                        'file': file_name,
+                        'entities': len(chunk),
+                        'bytes': top_bytes + sum(rendered[idx][2]['bytes'] for idx in chunk),
+                        'fields': sum(rendered[idx][2]['fields'] for idx in chunk)
+                        })
+            perf.count('entities', len(status['added_entities']))
+            perf.count('unchanged_entities', len(status.get('unchanged_entities', [])))
+            perf.count('errors', len(status['errors']))
+            status['performance'] = perf.finish()
+            return status
+
+        chunks = _chunk_by_count(entities, MAX_ITEMS_PER_CONFIG)
+
+        if workers and workers > 1:
+            # chunk boundaries and numbering are fixed before any file is written, map keeps them in order
+            chunks = list(chunks)
+            file_names = [dump_path.replace('.yaml', f'_pt{i}.yaml') for i in range(1, len(chunks) + 1)]
+            with perf.stage('emit'), ProcessPoolExecutor(max_workers=workers) as executor:
+                for file_name, chunk in zip(executor.map(write_config, file_names, chunks, repeat(None), repeat(config_top)), chunks):
+                    perf.count_file(file_name)
+                    perf.count('entities_written', len(chunk))
+                    status['saved_files'].append(f"{len(chunk)} entities saved in {file_name}.")
+        else:
+            for chunk_counter, chunk in enumerate(chunks, start=1):
+                file_name = write_config(dump_path.replace('.yaml', f'_pt{chunk_counter}.yaml'), chunk, perf, header=config_top)
+                status['saved_files'].append(f"{len(chunk)} entities saved in {file_name}.")
+        perf.count('entities', len(status['added_entities']))
+        perf.count('unchanged_entities', len(status.get('unchanged_entities', [])))
+        perf.count('errors', len(status['errors']))
+        status['performance'] = perf.finish()
+        return status
+
+
+class LinkGraph:
+    '''
+    Links from virtual entities to the entities they are linked to, built once from ABEL config.
+    Link targets are resolved from ABEL config first, then from building config.
+    Args:
+        abel_config: ABEL config
+        building_config: building config export
+        abel_flags: use 'operation' from ABEL config to split virtual entities into ADD and UPDATE, as export_add_config does
+    Attributes:
+        adjacency: virtual entity guid to tuple of linked guids, in config order
+        targets: linked guid to resolved entity, each target is resolved once, when it is first linked
+        dangling: (virtual entity guid, linked guid) pairs not found in ABEL and building config
+        duplicates: (virtual entity guid, linked guid, other virtual entity guid) triples. Either an UPDATE entity linking a target
+            already linked from the other, ADD entity, so the target is exported in both the add and update virtual configs, or
+            a target repeated in the links of one entity, with the entity guid as other. Loaded links are mappings and can't
+            repeat a target, only links built in code as lists can.
+    '''
+    def __init__(self, abel_config, building_config, abel_flags=True):
+        self.abel_config = AbelConfig.wrap(abel_config)
+        self.building_config = BuildingConfig.wrap(building_config)
+        self.adjacency = {}
+        self.dangling = []
+        self.duplicates = []
+
+        linked_from_add = {}
+        update_virtual = []
+        for key in self.abel_config.virtual:
+            links = {}
+            for link in self.abel_config[key]['links']:
+                if link in links:
+                    self.duplicates.append((key, link, key))
+                    continue
+                links[link] = None
+                if link not in self.abel_config and link not in self.building_config:
+                    self.dangling.append((key, link))
+            self.adjacency[key] = tuple(links)
+
+            operation = self.abel_config[key].get('operation') if abel_flags else 'ADD'
+            if operation == 'ADD':
+                for link in links:
+                    linked_from_add.setdefault(link, key)
+            elif operation == 'UPDATE':
+                update_virtual.append(key)
+
+        for key in update_virtual:
+            for link in self.adjacency[key]:
+                if link in linked_from_add:
+                    self.duplicates.append((key, link, linked_from_add[link]))
+        self.targets = {}
+
+    def _resolve(self, link):
+        '''
+        View of the linked entity without ABEL operation flags and with etag as str.
+        '''
+        if link in self.abel_config:
+            entity = self.abel_config[link]
+        elif link in self.building_config:
+            entity = self.building_config[link]
+        else:
+            return {}
+
+        removed = {field for field in ('operation', 'update_mask') if entity.get(field)}
+        overrides = {'etag': str(entity['etag'])} if entity.get('etag') else None
+        return EntityView(entity, overrides=overrides, removed=removed, keep_format=True)
+
+    def linked(self, guids):
+        '''
+        Resolved entities linked from guids, in order of first link.
+        '''
+        linked = {}
+        for key in guids:
+            for link in self.adjacency[key]:
+                if link not in self.targets:
+                    self.targets[link] = self._resolve(link)
+                linked[link] = self.targets[link]
+        return linked
+
+    def errors(self):
+        errors = []
+        for key, link in self.dangling:
+            errors.append(f"Link {link} from {self.abel_config[key].get('code')} (guid: {key}) not found in abel and building config.")
+        for key, link, other in self.duplicates:
+            if other == key:
+                errors.append(f"Duplicate link {link} from {self.abel_config[key].get('code')} (guid: {key}).")
+            else:
+                errors.append(f"Link {link} from {self.abel_config[key].get('code')} (guid: {key}) is also linked from ADD entity "
+                              f"{self.abel_config[other].get('code')} (guid: {other}), it would be exported in both add and update configs.")
+        return errors
+
+
+def export_add_config(building_config, abel_config, abel_flags, dump_path, perf = None):
     '''
     Exports Onboard-Add config yaml.
     Args:
         building_config_path: path to building config export (export a new building config after Onboard-Update operation!)
         abel_config_path: path to ABEL config
         dump_path: path to the new onboard-add yaml
+        perf: Instrumentation to record stage timings in, the report is returned in status['performance']
     '''
-    status = {
-            'errors': [],
-            'added_entities': [],
-            'saved_files': []
-            }
-
-    config_top = {}
-    config_top['CONFIG_METADATA'] = {'operation': "UPDATE"}
-    building = [{key: val} for key, val in building_config.items() if val.get('type') and val['type']=='FACILITIES/BUILDING'][0]
-    config_top = config_top | building
-
-    add_virtual = {}
-    update_virtual = {}
-    reporting_add_virtual = {}
-    reporting_update_virtual = {}
+    perf = perf or Instrumentation()
+    with perf:
+        status = {
+                'errors': [],
+                'added_entities': [],
+                'saved_files': []
+                }
 
-    for key, val in abel_config.items():
+        with perf.stage('index'):
+            building_config = BuildingConfig.wrap(building_config)
+            abel_config = AbelConfig.wrap(abel_config)
 
-        if val.get('links'):
-            if not abel_flags:
-                val['operation'] = 'ADD'
+            config_top = {}
+            config_top['CONFIG_METADATA'] = {'operation': "UPDATE"}
+            config_top = config_top | building_config.building
 
-            if val.get('update_mask') and isinstance(val['update_mask'], list):
-                val['update_mask'] = [i.lower() for i in val['update_mask']]
+        with perf.stage('links'):
+            link_graph = LinkGraph(abel_config, building_config, abel_flags)
+            status['errors'] += link_graph.errors()
 
-            if val.get('operation')=='ADD':
-                add_virtual[key] = val
-            if val.get('operation')=='UPDATE':
-                update_virtual[key] = val
+        with perf.stage('merge'):
+            add_virtual = {}
+            update_virtual = {}
 
-            for link in val['links']:
-                if link in abel_config:
-                    link_data = abel_config[link]
-                elif link in building_config:
-                    link_data = building_config[link]
-                else:
-                    link_data = {}
-                    status['errors'].append(f'Link {link} from {val.get('code')} (guid: {key}) not found in abel and building config.')
-
-                if link_data.get('operation'):
-                    link_data.pop('operation')
-                if link_data.get('update_mask'):
-                    link_data.pop('update_mask')
-                if link_data.get('etag'):
-                    link_data['etag'] = str(link_data['etag'])
+            for key in abel_config.virtual:
+                # loaded configs may be cached and shared, changed fields are overlaid on the ABEL entity
+                entity = abel_config[key]
+                overrides = {}
+                if not abel_flags:
+                    overrides['operation'] = 'ADD'
+                if entity.get('update_mask') and isinstance(entity['update_mask'], list):
+                    overrides['update_mask'] = [i.lower() for i in entity['update_mask']]
+                val = EntityView(entity, overrides=overrides, keep_format=True)
 
                 if val.get('operation')=='ADD':
-                    if link not in reporting_add_virtual:
-                        reporting_add_virtual[link] = link_data
+                    add_virtual[key] = val
                 if val.get('operation')=='UPDATE':
-                    if link not in reporting_update_virtual:
-                        reporting_update_virtual[link] = link_data
-
-    add_config = config_top | reporting_add_virtual | add_virtual
-    update_config = config_top | reporting_update_virtual | update_virtual
-    if len(reporting_add_virtual) > 0:
-        final_file_path = dump_path.replace('.yaml', '_add_virtual.yaml')
-        with open(f'{final_file_path}', 'w') as f:
-            for key, value in add_config.items():
-                yaml.dump({key: value}, f)
-                f.write('\n')
-            f.close()
+                    update_virtual[key] = val
+
+            reporting_add_virtual = link_graph.linked(add_virtual)
+            reporting_update_virtual = link_graph.linked(update_virtual)
+
+        if len(reporting_add_virtual) > 0:
+            final_file_path = dump_path.replace('.yaml', '_add_virtual.yaml')
+            with ConfigWriter(final_file_path, perf) as writer:
+                for key, value in merged_items(config_top, reporting_add_virtual, add_virtual):
+                    writer.write(key, value, count=key not in config_top)
             status['saved_files'].append(f"Saved file: {final_file_path}")
-    if len(reporting_update_virtual) > 0:
-        final_file_path = dump_path.replace('.yaml', '_update_virtual.yaml')
-        with open(f'{final_file_path}', 'w') as f:
-            for key, value in update_config.items():
-                yaml.dump({key: value}, f)
-                f.write('\n')
-            f.close()
+        if len(reporting_update_virtual) > 0:
+            final_file_path = dump_path.replace('.yaml', '_update_virtual.yaml')
+            with ConfigWriter(final_file_path, perf) as writer:
+                for key, value in merged_items(config_top, reporting_update_virtual, update_virtual):
+                    writer.write(key, value, count=key not in config_top)
             status['saved_files'].append(f"Saved file: {final_file_path}")
 
-    return status
+        perf.count('entities', len(add_virtual) + len(update_virtual))
+        perf.count('errors', len(status['errors']))
+        status['performance'] = perf.finish()
+        return status
 
 
-def update_etags(building_config, onboard_config, file_name):
+def update_etags(building_config, onboard_config, file_name, perf = None):
     '''
     Updates etags in existing onboard config.
     Args:
         building_config_path: path to building config export (export a new building config after Onboard-Update operation!)
         onboard_config_path: path to existing onboard config
+        perf: Instrumentation to record stage timings in, the report is returned in status['performance']
+    '''
+    perf = perf or Instrumentation()
+    with perf:
+        status = {
+                'errors': [],
+                'added_entities': [],
+                'saved_files': []
+                }
+
+        with perf.stage('index'):
+            building_config = BuildingConfig.wrap(building_config)
+
+        new_file_name = file_name.replace('.yaml','_upd.yaml')
+        with ConfigWriter(new_file_name, perf) as writer:
+            for guid, val in onboard_config.items():
+                with perf.stage('merge'):
+                    if _updates_etag(guid, val):
+                        if guid not in building_config:
+                            status['errors'].append(_not_in_building_config(guid, val))
+                        elif building_config[guid].get('etag'):
+                            val = EntityView(val, overrides={'etag': str(building_config[guid]['etag'])})
+                            perf.count('entities')
+                        else: status['errors'].append(_no_etag(guid, val))
+                writer.write(guid, val, count=guid != 'CONFIG_METADATA')
+        status['saved_files'].append(f"Saved file: {new_file_name}")
+
+        perf.count('errors', len(status['errors']))
+        status['performance'] = perf.finish()
+        return status
+
+
+# plain, single- or double-quoted scalar at the start of the etag value
+ETAG_VALUE = re.compile(r"""'(?:[^']|'')*'|"(?:[^"\\]|\\.)*"|[^\s#]+""")
+# etag key up to and including the colon
+ETAG_KEY = re.compile(r"""(?:etag|'etag'|"etag")[ \t]*:""")
+
+def update_etags_incremental(building_config, onboard_config, onboard_config_source, file_name, perf = None):
+    '''
+    Updates changed etags in existing onboard config. Only the etag lines are rewritten, the rest of the file is saved as is.
+    Args:
+        building_config: building config export (export a new building config after Onboard-Update operation!)
+        onboard_config: existing onboard config loaded with the 'rt' loader
+        onboard_config_source: contents of the existing onboard config file, str or bytes
+        file_name: path to existing onboard config, the updated config is saved with _upd suffix
+        perf: Instrumentation to record stage timings in, the report is returned in status['performance']
     '''
-    status = {
+    perf = perf or Instrumentation()
+    with perf:
+        status = {
+                'errors': [],
+                'added_entities': [],
+                'saved_files': [],
+                'changed_etags': []
+                }
+
+        with perf.stage('index'):
+            building_config = BuildingConfig.wrap(building_config)
+            if isinstance(onboard_config_source, bytes):
+                onboard_config_source = onboard_config_source.decode('UTF-8')
+            lines = onboard_config_source.splitlines(keepends=True)
+        inserts = []
+
+        with perf.stage('diff'):
+            for guid, val in onboard_config.items():
+                if not _updates_etag(guid, val):
+                    continue
+                if not hasattr(val, 'lc'):
+                    raise ValueError("Onboard config must be loaded with the 'rt' loader to update etags in place.")
+                if guid not in building_config:
+                    status['errors'].append(_not_in_building_config(guid, val))
+                    continue
+                if not building_config[guid].get('etag'):
+                    status['errors'].append(_no_etag(guid, val))
+                    continue
+
+                etag = str(building_config[guid]['etag'])
+                if val.get('etag') is not None and str(val['etag']) == etag:
+                    continue
+                new_value = "'" + etag.replace("'", "''") + "'"
+
+                if 'etag' in val:
+                    key_line, key_col = val.lc.key('etag')
+                    line, col = val.lc.value('etag')
+                    if line != key_line:
+                        # empty value, the value position is the next token: the etag is written after the key
+                        key = ETAG_KEY.match(lines[key_line], key_col)
+                        if not key:
+                            status['errors'].append(f"Can't update etag: {guid}, {val.get('code')}")
+                            continue
+                        lines[key_line] = lines[key_line][:key.end()] + ' ' + new_value + lines[key_line][key.end():]
+                    else:
+                        old_value = ETAG_VALUE.match(lines[line], col)
+                        lines[line] = lines[line][:col] + new_value + lines[line][old_value.end() if old_value else col:]
+                elif len(val) and not val.fa.flow_style():
+                    # line numbers are from the source, new lines are inserted after all etags are replaced
+                    line, col = val.lc.key(next(iter(val)))
+                    inserts.append((line, ' ' * col + f'etag: {new_value}\n'))
+                else:
+                    status['errors'].append(f"Can't add etag to flow style entity: {guid}, {val.get('code')}")
+                    continue
+                status['changed_etags'].append(guid)
+
+            for line, text in sorted(inserts, reverse=True):
+                lines.insert(line, text)
+
+        new_file_name = file_name.replace('.yaml','_upd.yaml')
+        with perf.stage('emit'):
+            with open(new_file_name, 'w') as f:
+                f.writelines(lines)
+        perf.count_file(new_file_name)
+        status['saved_files'].append(f"Saved file: {new_file_name}")
+        print(f"{len(status['changed_etags'])} etags changed")
+
+        perf.count('entities', len(status['changed_etags']))
+        perf.count('errors', len(status['errors']))
+        status['performance'] = perf.finish()
+        return status
+
+
+def validate_configs(building_config, abel_config, operation='update', abel_flags=True):
+    '''
+    Finds the errors an exporter would report, before any file is written. Entities the operation needs are checked against
+    the building config, links are checked by LinkGraph. Errors have the same text as the exporter errors.
+    Args:
+        building_config: building config export
+        abel_config: ABEL config, or existing onboard config for 'update-etags'
+        operation: 'update', 'add-virtual' or 'update-etags'
+        abel_flags: use 'operation' from ABEL config, as the exporter does
+    Returns:
+        dict with errors, the guids failing each check, numbers of entities and seconds taken
+    '''
+    start = time.perf_counter()
+    building_config = BuildingConfig.wrap(building_config)
+    abel_config = AbelConfig.wrap(abel_config)
+    report = {
+            'operation': operation,
             'errors': [],
-            'added_entities': [],
-            'saved_files': []
+            'building_entity': bool(building_config.by_type.get('FACILITIES/BUILDING')),
+            'not_in_building_config': [],
+            'missing_etags': [],
+            'dangling_links': [],
+            'duplicate_links': [],
+            'entities': {'building_config': len(building_config), 'abel_config': len(abel_config), 'checked': 0},
+            'seconds': None
             }
 
-    for guid, val in onboard_config.items():
-        if guid != 'CONFIG_METADATA' and any([val.get('operation') and val.get('operation').lower()=='update',
-                                              val.get('translation')]):
-            if building_config[guid].get('etag'):
-                onboard_config[guid] = onboard_config[guid] | {'etag': str(building_config[guid]['etag'])}
-            else: status['errors'].append(f"No etag for: {guid}, {val.get('code')}")
-
-    new_file_name = file_name.replace('.yaml','_upd.yaml')
-    with open(new_file_name, 'w') as f:
-        for key, value in onboard_config.items():
-            yaml.dump({key: value}, f)
-            f.write('\n')
-        f.close()
-    status['saved_files'].append(f"Saved file: {new_file_name}")
-
-    return status
+    if operation in ('update', 'add-virtual') and not report['building_entity']:
+        report['errors'].append('FACILITIES/BUILDING entity not found in building config.')
+
+    if operation in ('update', 'update-etags'):
+        checked = abel_config.reporting
+        if operation == 'update-etags':
+            checked = [guid for guid, entity in abel_config.items() if isinstance(entity, Mapping) and _updates_etag(guid, entity)]
+        report['entities']['checked'] = len(checked)
+
+        for guid in checked:
+            entity = abel_config[guid]
+            if guid not in building_config:
+                report['not_in_building_config'].append(guid)
+                # update_etags adds the entity code to the error
+                report['errors'].append(_not_in_building_config(guid, entity if operation == 'update-etags' else None))
+            elif not building_config[guid].get('etag'):
+                report['missing_etags'].append(guid)
+                report['errors'].append(_no_etag(guid, entity))
+
+    if operation == 'add-virtual':
+        link_graph = LinkGraph(abel_config, building_config, abel_flags)
+        report['dangling_links'] = link_graph.dangling
+        report['duplicate_links'] = link_graph.duplicates
+        report['entities']['checked'] = len(abel_config.virtual)
+        report['errors'] += link_graph.errors()
+
+    report['seconds'] = round(time.perf_counter() - start, 4)
+    return report
+
+
+def export_config(operation, building_config, abel_config, dump_path, abel_flags=True, max_items=50, workers=None, incremental=False,
+                  max_bytes=None, max_fields=None, abel_config_source=None, delta=False, perf=None):
+    '''
+    Runs one of the exporters on loaded configs.
+    Args:
+        operation: 'update', 'add-virtual' or 'update-etags'
+        abel_config: ABEL config, or existing onboard config for 'update-etags'
+        incremental: for 'update-etags', only rewrite changed etag lines of abel_config_source
+        abel_config_source: contents of the onboard config file, required for incremental 'update-etags'
+        delta: for 'update', only export entities that differ from the building config
+    Returns:
+        exporter status
+    '''
+    if operation == 'update':
+        return export_update_config(building_config, abel_config, abel_flags, dump_path, max_items=max_items, workers=workers,
+                                    max_bytes=max_bytes, max_fields=max_fields, delta=delta, perf=perf)
+    if operation == 'add-virtual':
+        return export_add_config(building_config, abel_config, abel_flags, dump_path, perf=perf)
+    if operation == 'update-etags' and incremental:
+        return update_etags_incremental(building_config, abel_config, abel_config_source, dump_path, perf=perf)
+    if operation == 'update-etags':
+        return update_etags(building_config, abel_config, dump_path, perf=perf)
+    raise ValueError(f'Unknown operation: {operation}')
+
+
+def run_operation(operation, building_config_path, abel_config_path, dump_path, abel_flags=True, max_items=50, workers=None, incremental=False,
+                  max_bytes=None, max_fields=None, building_loader='safe', snapshots=False, trace_memory=False, trace_path=None, delta=False,
+                  abel_loader='rt', strict=False):
+    '''
+    Loads configs from files, validates them and runs one of the exporters on them.
+    Args:
+        operation: 'update', 'add-virtual' or 'update-etags'
+        building_config_path: path to building config export
+        abel_config_path: path to ABEL config, or existing onboard config for 'update-etags'
+        dump_path: path to the new yaml, file names of the exported configs are derived from it
+        incremental: for 'update-etags', only rewrite changed etag lines
+        max_bytes, max_fields: for 'update', size budgets of the exported files, see export_update_config
+        building_loader: loader for the building config, 'stream' keeps only STREAM_FIELDS of every entity
+        snapshots: load configs from binary snapshots next to the files when they are up to date, save them otherwise
+        trace_memory: record tracemalloc peaks per stage in the performance report
+        trace_path: path to save the performance report to as JSON
+        delta: for 'update', only export entities that differ from the building config
+        abel_loader: loader for the ABEL config, 'compact' for very large configs. Incremental 'update-etags' needs 'rt'.
+        strict: do not export if validation finds errors
+    Returns:
+        dict with operation, paths, validation report, exporter status and timings in seconds
+    '''
+    result = {
+            'operation': operation,
+            'building_config': building_config_path,
+            'abel_config': abel_config_path,
+            'dump_path': dump_path,
+            'validation': None,
+            'status': None,
+            'error': None,
+            'timings': {}
+            }
+    start = time.perf_counter()
+    try:
+        with Instrumentation(trace_memory, trace_path) as perf:
+            load = load_config_snapshot if snapshots else load_config
+            with perf.stage('parse'):
+                building_config = BuildingConfig(load(building_config_path, loader=building_loader))
+                abel_config = AbelConfig(load(abel_config_path, loader=abel_loader))
+            parsed = time.perf_counter()
+            result['timings']['parse'] = round(parsed - start, 3)
+
+            with perf.stage('validate'):
+                result['validation'] = validate_configs(building_config, abel_config, operation, abel_flags)
+            if strict and result['validation']['errors']:
+                raise ValueError(f"Validation found {len(result['validation']['errors'])} errors, nothing exported.")
+
+            abel_config_source = None
+            if operation == 'update-etags' and incremental:
+                with open(abel_config_path, 'r') as f:
+                    abel_config_source = f.read()
+            result['status'] = export_config(operation, building_config, abel_config, dump_path, abel_flags, max_items, workers, incremental,
+                                             max_bytes, max_fields, abel_config_source, delta, perf)
+            result['timings']['export'] = round(time.perf_counter() - parsed, 3)
+    except Exception as e:
+        result['error'] = f'{type(e).__name__}: {e}'
+    result['timings']['total'] = round(time.perf_counter() - start, 3)
+    return result
+
+
+def run_batch(manifest, operation='update', abel_flags=True, max_items=50, workers=None, snapshots=False, strict=False):
+    '''
+    Runs an exporter for every building in the manifest, buildings are processed in parallel.
+    Args:
+        manifest: list of dicts with building_config, abel_config and dump_path paths. Optional 'name' and 'operation' override the defaults per building.
+        operation: default operation for the manifest entries
+        workers: number of processes. Default: None, number of CPUs.
+        snapshots: load configs from binary snapshots, see run_operation
+        strict: skip buildings with validation errors, see run_operation
+    Returns:
+        list of run_operation results in manifest order, with the building name added
+    '''
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(run_operation, entry.get('operation', operation), entry['building_config'], entry['abel_config'],
+                                   entry['dump_path'], abel_flags, max_items, snapshots=snapshots, strict=strict)
+                   for entry in manifest]
+        results = []
+        for entry, future in zip(manifest, futures):
+            results.append({'name': entry.get('name', entry['building_config'])} | future.result())
+    return results
+
+
+def unpack_files(files):
+    '''
+    Expands zip archives into the yaml files they contain.
+    Args:
+        files: dict of file name: contents as bytes
+    Returns:
+        dict of file name: contents, files from an archive are named archive.zip/path/in/archive.yaml
+    '''
+    unpacked = {}
+    for name, data in files.items():
+        if not zipfile.is_zipfile(io.BytesIO(data)):
+            unpacked[name] = data
+            continue
+        with zipfile.ZipFile(io.BytesIO(data)) as archive:
+            for info in archive.infolist():
+                if info.is_dir() or info.filename.startswith('__MACOSX/') or not info.filename.lower().endswith(('.yaml', '.yml')):
+                    continue
+                unpacked[f'{name}/{info.filename}'] = archive.read(info)
+    return unpacked
+
+
+CONFIG_METADATA_KEY = re.compile(rb'^CONFIG_METADATA\s*:', re.M)
+TOP_LEVEL_LINE = re.compile(rb'\n[^\s#]')
+BUILDING_TYPE = re.compile(rb'^[ \t]+type:[ \t]*["\']?FACILITIES/BUILDING\b', re.M)
+BUILDING_CODE = re.compile(rb'^[ \t]+code:[ \t]*["\']?([^"\'\s]+)', re.M)
+
+
+def _building_code(data):
+    '''
+    Code of the FACILITIES/BUILDING entity in config contents, found without parsing the config. None if there is no building entity.
+    '''
+    position = data.find(b'FACILITIES/BUILDING')
+    while position != -1:
+        # the entity is everything between the last and the next line that is not indented
+        start = data.rfind(b'\n', 0, position) + 1
+        while start > 0 and data[start:start + 1] in b' \t#\r\n':
+            start = data.rfind(b'\n', 0, start - 1) + 1
+        next_entity = TOP_LEVEL_LINE.search(data, position)
+        entity = data[start:next_entity.start() if next_entity else len(data)]
+        code = BUILDING_CODE.search(entity)
+        if BUILDING_TYPE.search(entity) and code:
+            return code.group(1).decode('UTF-8')
+        position = data.find(b'FACILITIES/BUILDING', position + 1)
+    return None
+
+
+def match_config_files(files):
+    '''
+    Pairs building config exports with their ABEL configs. Files with CONFIG_METADATA are ABEL configs, all others building config exports.
+    An ABEL config is matched to the building config with the same building code (code of the FACILITIES/BUILDING entity),
+    then to the building config in the same folder if the folder has one of each, then to the building config whose code is in the ABEL config file name.
+    Args:
+        files: dict of file name: contents as bytes, see unpack_files
+    Returns:
+        (pairs, errors): list of dicts with name, building_file, abel_file, building_config and abel_config contents, and list of errors
+    '''
+    buildings = {}
+    abel_files = []
+    for name, data in files.items():
+        if CONFIG_METADATA_KEY.search(data):
+            abel_files.append(name)
+        else:
+            buildings[name] = _building_code(data)
+
+    pairs = []
+    errors = []
+    matched = {}
+    for abel_file in abel_files:
+        code = _building_code(files[abel_file])
+        folder = posixpath.dirname(abel_file)
+        candidates = [name for name, building_code in buildings.items() if code and building_code == code]
+        if not candidates:
+            candidates = [name for name in buildings if posixpath.dirname(name) == folder]
+            if len(candidates) != 1 or sum(posixpath.dirname(name) == folder for name in abel_files) != 1:
+                candidates = []
+        if not candidates:
+            file_name = posixpath.basename(abel_file).lower()
+            candidates = [name for name, building_code in buildings.items() if building_code and building_code.lower() in file_name]
+
+        if len(candidates) != 1:
+            errors.append(f"{'Several' if candidates else 'No'} building configs found for ABEL config: {abel_file}")
+            continue
+        building_file = candidates[0]
+        if building_file in matched:
+            errors.append(f'Building config {building_file} matched to ABEL configs {matched[building_file]} and {abel_file}')
+            continue
+        matched[building_file] = abel_file
+        name = buildings[building_file] or posixpath.splitext(posixpath.basename(building_file))[0]
+        pairs.append({
+                'name': name,
+                'building_file': building_file,
+                'abel_file': abel_file,
+                'building_config': files[building_file],
+                'abel_config': files[abel_file]
+                })
+
+    for building_file in buildings:
+        if building_file not in matched:
+            errors.append(f'No ABEL config found for building config: {building_file}')
+    return pairs, errors
+
+
+class BulkExport:
+    '''
+    Runs an exporter for many buildings in a background thread pool. Configs are parsed and exported in the pool,
+    the caller polls progress and collects the exported files as one zip archive when all buildings are done.
+    Args:
+        pairs: building/ABEL config pairs, see match_config_files
+        operation: 'update', 'add-virtual' or 'update-etags'
+        workers: number of buildings exported at the same time
+        cache: ConfigCache to parse configs with. Default: None, configs are parsed for this export only.
+        options: other export_config arguments, e.g. abel_flags, max_items, perf is not supported
+    '''
+    def __init__(self, pairs, operation='update', workers=4, cache=None, **options):
+        self.operation = operation
+        self.cache = cache
+        self.options = options
+        self.dump_dir = tempfile.mkdtemp(prefix='onboard_export_')
+        self._zip = None
+        executor = ThreadPoolExecutor(max_workers=workers)
+        self.futures = [executor.submit(self._export, pair) for pair in pairs]
+        # threads finish the submitted buildings, nothing waits for them here
+        executor.shutdown(wait=False)
+
+    def _load(self, data, config_cls, loader):
+        if self.cache is not None:
+            return self.cache.load(data, config_cls, loader=loader)
+        return config_cls(load_config(data, loader=loader))
+
+    def _export(self, pair):
+        name = re.sub(r'[^\w.-]', '_', pair['name'])
+        result = {
+                'name': pair['name'],
+                'building_config': pair['building_file'],
+                'abel_config': pair['abel_file'],
+                'validation': None,
+                'status': None,
+                'error': None
+                }
+        try:
+            os.makedirs(os.path.join(self.dump_dir, name), exist_ok=True)
+            building_config = self._load(pair['building_config'], BuildingConfig, 'safe')
+            abel_config = self._load(pair['abel_config'], AbelConfig, 'rt')
+            result['validation'] = validate_configs(building_config, abel_config, self.operation, self.options.get('abel_flags', True))
+            result['status'] = export_config(self.operation, building_config, abel_config, os.path.join(self.dump_dir, name, f'{name}.yaml'),
+                                             abel_config_source=pair['abel_config'], **self.options)
+        except Exception as e:
+            result['error'] = f'{type(e).__name__}: {e}'
+        return result
+
+    @property
+    def done(self):
+        return all(future.done() for future in self.futures)
+
+    def progress(self):
+        '''
+        Returns (number of exported buildings, number of buildings).
+        '''
+        return sum(future.done() for future in self.futures), len(self.futures)
+
+    def results(self):
+        '''
+        Results of the exported buildings so far, in the order of the pairs.
+        '''
+        return [future.result() for future in self.futures if future.done()]
+
+    def to_zip(self):
+        '''
+        Returns the exported files of all buildings and report.json with their results as zip archive bytes.
+        The exported files are removed from disk, the archive is kept and returned by later calls.
+        '''
+        if self._zip is None:
+            results = [future.result() for future in self.futures]
+            buffer = io.BytesIO()
+            with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+                for root, folders, file_names in os.walk(self.dump_dir):
+                    folders.sort()
+                    for file_name in sorted(file_names):
+                        path = os.path.join(root, file_name)
+                        archive.write(path, os.path.relpath(path, self.dump_dir))
+                archive.writestr('report.json', json.dumps(results, indent=2, default=str))
+            self._zip = buffer.getvalue()
+            shutil.rmtree(self.dump_dir, ignore_errors=True)
+        return self._zip
+
+
+def write_report(results, report_path):
+    '''
+    Saves run results as JSON.
+    '''
+    with open(report_path, 'w') as f:
+        json.dump(results, f, indent=2, default=str)
+
+
+def main(argv=None):
+    '''
+    Command line entry point. Returns the exit status: 1 if an export failed, a batch entry failed,
+    or errors were found with --strict, 0 otherwise.
+    '''
+    parser = argparse.ArgumentParser(prog='python -m onboarding_utils', description='Export onboard configs from building config exports and ABEL configs.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    export_flags = argparse.ArgumentParser(add_help=False)
+    export_flags.add_argument('--ignore-abel-flags', action='store_true', help="ignore 'operation' and 'update_mask' from ABEL config")
+    export_flags.add_argument('--max-items', type=int, default=50, help='max number of entities per exported update file')
+    export_flags.add_argument('--report', default=None, help='path to save JSON status report to')
+    export_flags.add_argument('--strict', action='store_true', help='do not export if validation finds errors')
+    export_flags.add_argument('--snapshot', action='store_true', help='load configs from binary snapshots next to the files if they did not change, save the snapshots otherwise')
+
+    # batch results already carry the performance report of every building
+    trace_flags = argparse.ArgumentParser(add_help=False)
+    trace_flags.add_argument('--trace', default=None, help='path to save JSON performance trace (stage timings, counters) to')
+    trace_flags.add_argument('--trace-memory', action='store_true', help='record tracemalloc peak per stage in the performance trace')
+
+    update_parser = subparsers.add_parser('update', parents=[export_flags, trace_flags], help='export Onboard-Update config')
+    update_parser.add_argument('--workers', type=int, default=None, help='number of processes to write exported files with')
+    update_parser.add_argument('--max-bytes', type=int, default=None, help='max size of the entities in one exported file, packs entities into as few files as possible')
+    update_parser.add_argument('--max-fields', type=int, default=None, help='max number of translated fields in one exported file')
+    update_parser.add_argument('--delta', action='store_true', help='only export entities whose masked fields differ from the building config, with update_mask narrowed to the changed fields')
+    update_parser.add_argument('--stream', action='store_true', help=f"parse building config entity by entity keeping only {', '.join(STREAM_FIELDS)}")
+    add_parser = subparsers.add_parser('add-virtual', parents=[export_flags, trace_flags], help='export Onboard-Add config for virtual entities')
+    for subparser in (update_parser, add_parser):
+        subparser.add_argument('--compact', action='store_true', help='hold ABEL config as compact records, for very large configs. Comments and styling are not kept.')
+        subparser.add_argument('building_config', help='path to building config export')
+        subparser.add_argument('abel_config', help='path to ABEL config')
+        subparser.add_argument('dump_path', help='path to the new onboard yaml')
+
+    etags_parser = subparsers.add_parser('update-etags', parents=[trace_flags], help='update etags in existing onboard config')
+
+    etags_parser.add_argument('building_config', help='path to building config export')
+    etags_parser.add_argument('onboard_config', help='path to existing onboard config')
+    etags_parser.add_argument('dump_path', nargs='?', default=None, help='path to the updated yaml, _upd is added to the file name. Default: onboard config path')
+    etags_parser.add_argument('--incremental', action='store_true', help='only rewrite changed etag lines, keep the rest of the file as is')
+    etags_parser.add_argument('--stream', action='store_true', help=f"parse building config entity by entity keeping only {', '.join(STREAM_FIELDS)}")
+    etags_parser.add_argument('--report', default=None, help='path to save JSON status report to')
+    etags_parser.add_argument('--strict', action='store_true', help='do not update etags if validation finds errors')
+    etags_parser.add_argument('--snapshot', action='store_true', help='load configs from binary snapshots next to the files if they did not change, save the snapshots otherwise')
+
+    batch_parser = subparsers.add_parser('batch', parents=[export_flags], help='run an exporter for every building in a manifest')
+    batch_parser.add_argument('manifest', help='JSON list of {"building_config", "abel_config", "dump_path"[, "name", "operation"]}')
+    batch_parser.add_argument('--operation', choices=['update', 'add-virtual', 'update-etags'], default='update', help='default operation for the manifest entries')
+    batch_parser.add_argument('--workers', type=int, default=None, help='number of buildings to process in parallel')
+    batch_parser.set_defaults(report='batch_report.json')
+
+    args = parser.parse_args(argv)
+    if args.command == 'update' and args.workers and args.workers > 1 and (args.max_bytes or args.max_fields):
+        update_parser.error('--workers can not be used with --max-bytes or --max-fields')
+
+    if args.command == 'batch':
+        with open(args.manifest, 'r') as f:
+            manifest = json.load(f)
+        results = run_batch(manifest, args.operation, not args.ignore_abel_flags, args.max_items, args.workers, args.snapshot, args.strict)
+        write_report(results, args.report)
+        failed = [result for result in results if result['error'] or result['status']['errors']]
+        print(f'{len(results)} buildings processed, {len(failed)} with errors. Report saved in {args.report}.')
+        return 1 if failed else 0
+
+    if args.command == 'update-etags':
+        result = run_operation(args.command, args.building_config, args.onboard_config, args.dump_path or args.onboard_config,
+                               incremental=args.incremental, building_loader='stream' if args.stream else 'safe', snapshots=args.snapshot,
+                               trace_memory=args.trace_memory, trace_path=args.trace, strict=args.strict)
+    else:
+        result = run_operation(args.command, args.building_config, args.abel_config, args.dump_path,
+                               not args.ignore_abel_flags, args.max_items, getattr(args, 'workers', None),
+                               max_bytes=getattr(args, 'max_bytes', None), max_fields=getattr(args, 'max_fields', None),
+                               building_loader='stream' if getattr(args, 'stream', False) else 'safe', snapshots=args.snapshot,
+                               trace_memory=args.trace_memory, trace_path=args.trace, delta=getattr(args, 'delta', False),
+                               abel_loader='compact' if args.compact else 'rt', strict=args.strict)
+
+    if result['error']:
+        if result['validation']:
+            for error in result['validation']['errors']:
+                print(error)
+        print(result['error'])
+    else:
+        for error in result['status']['errors']:
+            print(error)
+        for saved_file in result['status']['saved_files']:
+            print(saved_file)
+        if 'unchanged_entities' in result['status']:
+            print(f"{len(result['status']['unchanged_entities'])} entities unchanged, not exported")
+        for chunk in result['status'].get('chunks', []):
+            print(f"{chunk['file']}: {chunk['entities']} entities, {chunk['bytes']} bytes, {chunk['fields']} fields")
+        print(', '.join(f'{stage} {seconds:.3f} s' for stage, seconds in result['status']['performance']['stages'].items()))
+    if args.report:
+        write_report(result, args.report)
+    if result['error'] or (args.strict and result['status']['errors']):
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    # run from the imported module, so that snapshots pickle configs as onboarding_utils.* and not __main__.*
+    import onboarding_utils
+    sys.exit(onboarding_utils.main())
@@ -0,0 +1,320 @@
+import argparse
+import asyncio
+import glob
+import re
+import shlex
+import threading
+import time
+from abc import ABC, abstractmethod
+
+SERVICE = 'blade:google.cloud.digitalbuildings.v1alpha1.digitalbuildingsservice-prod'
+METHOD = 'google.cloud.digitalbuildings.v1alpha1.DigitalBuildingsService'
+PROFILE = 'projects/digitalbuildings/profiles/MaintenanceOps'
+
+CHUNK_NUMBER = re.compile(r'_pt(\d+)\.yaml$')
+OPERATION_ID = re.compile(r'operations/([\w.-]+)')
+OPERATION_ID_VALUE = re.compile(r'[\w.-]+')
+ERROR_MESSAGE = re.compile(r'message:\s*"((?:[^"\\]|\\.)*)"')
+
+
+def building_name(building_code):
+    '''
+    DB API resource name of a building.
+    Args:
+        building_code: building code, e.g. US-MTV-1
+    '''
+    building_split = str.split(building_code.lower(), "-")
+    if len(building_split)!=3:
+        raise ValueError(f'Building code must be COUNTRY-CITY-BUILDING: {building_code}')
+    building_country, building_city, building_code = building_split
+    return f'projects/digitalbuildings/countries/{building_country}/cities/{building_city}/buildings/{building_code}'
+
+
+def export_building_config_command(building_code, guids=None):
+    '''
+    ExportBuildingConfig call, for all entities or only the entities in guids.
+    '''
+    request = f"name: '{building_name(building_code)}', profile:'{PROFILE}'"
+    if guids:
+        request += ",instance_guid:[" + ",".join(f"'{guid}'" for guid in guids) + "]"
+    return f'stubby call {SERVICE} {METHOD}.ExportBuildingConfig --deadline=60000 --print_status_extensions --proto2 "{request}"'
+
+
+def onboard_building_command(building_code, config_path):
+    '''
+    OnboardBuilding call with the onboard config at config_path.
+    '''
+    return (f'stubby call {SERVICE} {METHOD}.OnboardBuilding --print_status_extensions --proto2 '
+            f'"name: \'{building_name(building_code)}\', profile:\'{PROFILE}\'" --set_field {shlex.quote(f"topology_file=readfile({config_path})")}')
+
+
+def get_operation_command(building_code, operation_id, output_path=None, binary_output=True):
+    '''
+    GetOperation call for an operation of the building.
+    Args:
+        output_path: file to save the operation to. Default: None, the operation is printed.
+        binary_output: print the operation as binary proto
+    '''
+    flags = '--print_status_extensions --proto2'
+    if output_path:
+        flags += f' --outfile={output_path}'
+    if binary_output:
+        flags += ' --binary_output'
+    return (f'stubby call {SERVICE} {METHOD}.GetOperation  {flags} '
+            f'"name: \'{building_name(building_code)}\', profile:\'{PROFILE}\', operation_name: \'{operation_id}\'"')
+
+
+def get_operation_args(building_code, operation_id):
+    '''
+    Arguments of a GetOperation call printing the operation as text, to run stubby without a shell.
+    '''
+    return ['stubby', 'call', SERVICE, f'{METHOD}.GetOperation', '--print_status_extensions', '--proto2',
+            f"name: '{building_name(building_code)}', profile:'{PROFILE}', operation_name: '{operation_id}'"]
+
+
+def exported_files(dump_path):
+    '''
+    Paths of the _ptN.yaml files exported by export_update_config for dump_path, in chunk order.
+    '''
+    files = glob.glob(glob.escape(dump_path.replace('.yaml', '')) + '_pt*.yaml')
+    files = [path for path in files if CHUNK_NUMBER.search(path)]
+    return sorted(files, key=lambda path: int(CHUNK_NUMBER.search(path).group(1)))
+
+
+def onboard_script(building_code, config_paths, log_path='onboard_operations.log'):
+    '''
+    Bash script calling OnboardBuilding for every config, one after another.
+    The output of every call is appended to log_path, operation IDs can be read from it with parse_operation_ids.
+    Args:
+        building_code: building code, e.g. US-MTV-1
+        config_paths: paths of the onboard configs, e.g. exported_files(dump_path)
+        log_path: path of the log file on the machine running the script
+    '''
+    log = shlex.quote(log_path)
+    lines = [
+            '#!/bin/bash',
+            f'# OnboardBuilding calls for {building_code}, {len(config_paths)} configs',
+            'set -u',
+            'failed=0',
+            ''
+            ]
+    for counter, config_path in enumerate(config_paths, start=1):
+        lines += [
+                f'echo "[{counter}/{len(config_paths)}]" {shlex.quote(config_path)} | tee -a {log}',
+                f'{onboard_building_command(building_code, config_path)} 2>&1 | tee -a {log}',
+                f'[ "${{PIPESTATUS[0]}}" -eq 0 ] || failed=$((failed + 1))',
+                ''
+                ]
+    lines += [
+            f'echo "$failed of {len(config_paths)} calls failed. Operations are logged in" {log}',
+            '[ "$failed" -eq 0 ]',
+            ''
+            ]
+    return '\n'.join(lines)
+
+
+def parse_operation_ids(text):
+    '''
+    Operation IDs in OnboardBuilding output, in order of first appearance.
+    '''
+    return list(dict.fromkeys(OPERATION_ID.findall(text)))
+
+
+class Transport(ABC):
+    '''
+    Fetches the state of DB API operations for the poller.
+    '''
+    @abstractmethod
+    async def get_operation(self, building_code, operation_id):
+        '''
+        Returns a dict with 'done' (bool) and 'error' (message, None if the operation did not fail).
+        '''
+
+
+class StubbyTransport(Transport):
+    '''
+    Calls GetOperation with the stubby command line tool.
+    Args:
+        timeout: seconds to wait for one call
+    '''
+    def __init__(self, timeout=60):
+        self.timeout = timeout
+
+    async def get_operation(self, building_code, operation_id):
+        # no shell, operation IDs typed in the app are passed to stubby as they are
+        process = await asyncio.create_subprocess_exec(
+                *get_operation_args(building_code, operation_id),
+                stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT)
+        try:
+            output, _ = await asyncio.wait_for(process.communicate(), self.timeout)
+        except asyncio.TimeoutError:
+            process.kill()
+            raise
+        output = output.decode('UTF-8', errors='replace')
+        if process.returncode != 0:
+            raise RuntimeError(f'GetOperation failed for {operation_id}: {output.strip()}')
+        error = None
+        if re.search(r'^\s*error\s*\{', output, re.M):
+            message = ERROR_MESSAGE.search(output)
+            error = message.group(1) if message else 'operation failed'
+        return {'done': bool(re.search(r'^\s*done:\s*true', output, re.M)), 'error': error}
+
+
+class LocalTransport(Transport):
+    '''
+    In-memory operations for trying out the poller without DB API access.
+    Args:
+        polls_until_done: dict of operation ID: number of polls before the operation is done. Unknown operations are done at once.
+        errors: dict of operation ID: error message of the operations that fail
+    '''
+    def __init__(self, polls_until_done=None, errors=None):
+        self.polls_until_done = dict(polls_until_done or {})
+        self.errors = errors or {}
+        self.calls = []
+
+    async def get_operation(self, building_code, operation_id):
+        self.calls.append(operation_id)
+        remaining = self.polls_until_done.get(operation_id, 1) - 1
+        self.polls_until_done[operation_id] = remaining
+        done = remaining <= 0
+        return {'done': done, 'error': self.errors.get(operation_id) if done else None}
+
+
+async def _poll_operation(transport, building_code, operation_id, semaphore, initial_delay, max_delay, backoff, deadline, on_update):
+    result = {'operation_id': operation_id, 'done': False, 'error': None, 'polls': 0}
+    delay = initial_delay
+    while True:
+        async with semaphore:
+            try:
+                result.update(await transport.get_operation(building_code, operation_id))
+            except Exception as e:
+                # failed calls are retried with the same backoff, the last failure is reported if the deadline is reached
+                result['error'] = f'{type(e).__name__}: {e}'
+        result['polls'] += 1
+        if on_update:
+            on_update(dict(result))
+        if result['done']:
+            return result
+        if deadline is not None and time.monotonic() + delay > deadline:
+            result['error'] = result['error'] or 'Timed out'
+            return result
+        await asyncio.sleep(delay)
+        delay = min(delay * backoff, max_delay)
+
+
+async def poll_operations(transport, building_code, operation_ids, initial_delay=5, max_delay=120, backoff=2, timeout=None,
+                          concurrency=10, on_update=None):
+    '''
+    Polls operations until they are done, each with exponential backoff.
+    Args:
+        transport: Transport to get operations with
+        building_code: building code, e.g. US-MTV-1
+        operation_ids: IDs of the operations to poll
+        initial_delay: seconds between the first and second poll of an operation
+        max_delay: max seconds between two polls of an operation
+        backoff: factor the delay grows by after every poll
+        timeout: seconds after which operations still running are reported as timed out. Default: None, poll until done.
+        concurrency: max number of calls in flight
+        on_update: called with the state of an operation after every poll
+    Returns:
+        list of dicts with operation_id, done, error and polls, in order of operation_ids
+    '''
+    semaphore = asyncio.Semaphore(concurrency)
+    deadline = time.monotonic() + timeout if timeout is not None else None
+    return list(await asyncio.gather(*[
+            _poll_operation(transport, building_code, operation_id, semaphore, initial_delay, max_delay, backoff, deadline, on_update)
+            for operation_id in operation_ids]))
+
+
+def wait_for_operations(transport, building_code, operation_ids, **options):
+    '''
+    Runs poll_operations to completion, see its arguments.
+    '''
+    return asyncio.run(poll_operations(transport, building_code, operation_ids, **options))
+
+
+class OperationPoll:
+    '''
+    Runs wait_for_operations in a background thread, the caller reads the state of every operation while they are polled.
+    Args:
+        transport: Transport to get operations with
+        building_code: building code, e.g. US-MTV-1
+        operation_ids: IDs of the operations to poll
+        options: other poll_operations arguments, e.g. timeout, on_update is not supported
+    '''
+    def __init__(self, transport, building_code, operation_ids, **options):
+        self._states = {operation_id: {'operation_id': operation_id, 'done': False, 'error': None, 'polls': 0}
+                        for operation_id in operation_ids}
+        self._lock = threading.Lock()
+        self._results = None
+        self.error = None
+        self._thread = threading.Thread(target=self._poll, args=(transport, building_code, list(self._states), options), daemon=True)
+        self._thread.start()
+
+    def _update(self, result):
+        with self._lock:
+            self._states[result['operation_id']] = result
+
+    def _poll(self, transport, building_code, operation_ids, options):
+        try:
+            self._results = wait_for_operations(transport, building_code, operation_ids, on_update=self._update, **options)
+        except Exception as e:
+            self.error = f'{type(e).__name__}: {e}'
+
+    @property
+    def done(self):
+        return not self._thread.is_alive()
+
+    def states(self):
+        '''
+        Latest state of every operation, in order of operation_ids.
+        '''
+        with self._lock:
+            return [dict(state) for state in self._states.values()]
+
+    def results(self):
+        '''
+        poll_operations results when done, the latest states otherwise.
+        '''
+        return self._results if self._results is not None else self.states()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m stubby_utils', description='Generate OnboardBuilding scripts and poll DB API operations.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    script_parser = subparsers.add_parser('script', help='print a bash script calling OnboardBuilding for every exported _ptN.yaml file')
+    script_parser.add_argument('building_code', help='building code, e.g. US-MTV-1')
+    script_parser.add_argument('dump_path', help='dump path the configs were exported with, e.g. onboard_update.yaml')
+    script_parser.add_argument('--log', default='onboard_operations.log', help='file the script logs the calls to')
+
+    poll_parser = subparsers.add_parser('poll', help='poll operations until they are done')
+    poll_parser.add_argument('building_code', help='building code, e.g. US-MTV-1')
+    poll_parser.add_argument('operation_ids', nargs='*', help='operation IDs')
+    poll_parser.add_argument('--log', default=None, help='read operation IDs from the log of an onboard script')
+    poll_parser.add_argument('--timeout', type=float, default=None, help='seconds to poll for')
+    poll_parser.add_argument('--concurrency', type=int, default=10, help='max number of GetOperation calls in flight')
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'script':
+        config_paths = exported_files(args.dump_path)
+        if not config_paths:
+            parser.error(f"No _ptN.yaml files found for {args.dump_path}")
+        print(onboard_script(args.building_code, config_paths, args.log), end='')
+        return
+
+    operation_ids = list(args.operation_ids)
+    if args.log:
+        with open(args.log, 'r') as f:
+            operation_ids += parse_operation_ids(f.read())
+    results = wait_for_operations(StubbyTransport(), args.building_code, list(dict.fromkeys(operation_ids)),
+                                  timeout=args.timeout, concurrency=args.concurrency,
+                                  on_update=lambda result: print(f"{result['operation_id']}: {'done' if result['done'] else 'running'}"
+                                                                 f"{', ' + result['error'] if result['error'] else ''}"))
+    failed = [result for result in results if result['error']]
+    print(f'{len(results)} operations, {len(failed)} failed or timed out.')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,255 @@
+import io
+import os
+import subprocess
+import sys
+
+from ruamel.yaml import YAML
+
+import onboarding_utils
+from onboarding_utils import (ConfigWriter, EntityView, LinkGraph, load_config_snapshot, load_snapshot, render_entities, save_snapshot,
+                              update_etags, update_etags_incremental, validate_configs, write_config)
+
+CONFIG = '''\
+CONFIG_METADATA:
+  operation: UPDATE
+2f0c8f0e-0000-4000-8000-000000000001:
+  code: US-SVL-BLDG1  # building
+  type: FACILITIES/BUILDING
+  etag: '1000'
+2f0c8f0e-0000-4000-8000-000000000002:
+  code: FCU-1
+  type: HVAC/FCU_DFSS_DFVSC
+  cloud_device_id: '2000000001'
+  tags: [a, b]   # flow style list
+  translation:
+    zone_air_temperature_sensor:
+      present_value: points.zone_air_temperature_sensor.present_value
+      units:
+        key: pointset.points.zone_air_temperature_sensor.units
+        values: {degrees_celsius: degC}
+  operation: UPDATE
+  update_mask: [TYPE, TRANSLATION]
+# virtual entity
+2f0c8f0e-0000-4000-8000-000000000003:
+  code: VIRTUAL-1
+  type: HVAC/ZONE
+  links:
+    2f0c8f0e-0000-4000-8000-000000000002:
+      zone_air_temperature_sensor: zone_air_temperature_sensor
+  description: "multi word, quoted"
+  operation: ADD
+'''
+
+
+def load_rt(text):
+    return YAML(typ='rt').load(text)
+
+
+def dump_per_entity(entities):
+    '''
+    Output of the exporters before ConfigWriter: yaml.dump({key: value}) and an empty line for every entity.
+    '''
+    yaml = YAML(typ='rt')
+    stream = io.StringIO()
+    for key, value in entities:
+        yaml.dump({key: value}, stream)
+        stream.write('\n')
+    return stream.getvalue()
+
+
+def test_config_writer_matches_per_entity_dump():
+    config = load_rt(CONFIG)
+    stream = io.StringIO()
+    with ConfigWriter(stream) as writer:
+        for key, value in config.items():
+            writer.write(key, value)
+    assert stream.getvalue() == dump_per_entity(config.items())
+
+
+def test_write_config_file_matches_per_entity_dump(tmp_path):
+    config = load_rt(CONFIG)
+    file_path = write_config(str(tmp_path / 'config.yaml'), config.items())
+    with open(file_path) as f:
+        assert f.read() == dump_per_entity(config.items())
+
+
+def test_render_entities_matches_per_entity_dump():
+    config = load_rt(CONFIG)
+    for key, value, text in render_entities(config.items()):
+        assert text == dump_per_entity([(key, value)])
+
+
+def test_entity_view_keeps_format_of_rt_entity():
+    config = load_rt(CONFIG)
+    views = [(key, EntityView(value, keep_format=True)) for key, value in config.items()]
+    stream = io.StringIO()
+    with ConfigWriter(stream) as writer:
+        for key, value in views:
+            writer.write(key, value)
+    assert stream.getvalue() == dump_per_entity(config.items())
+
+
+ONBOARD_CONFIG = '''\
+CONFIG_METADATA:
+  operation: UPDATE
+g-plain:
+  code: PLAIN
+  etag: 10
+  translation:
+    zone_air_temperature_sensor:
+      present_value: points.temp.present_value
+  operation: UPDATE
+g-quoted:
+  code: QUOTED
+  etag: 'old''etag'   # etag from last export
+  operation: UPDATE
+g-null:
+  etag:
+  code: EMPTY-ETAG
+  operation: UPDATE
+g-missing:
+  code: MISSING
+  operation: UPDATE
+g-flow: {code: FLOW, etag: '20', operation: UPDATE}
+g-flow-missing: {code: FLOW-MISSING, operation: UPDATE}
+g-same:
+  code: SAME
+  etag: '30'
+  operation: UPDATE
+'''
+
+ETAG_BUILDING_CONFIG = {
+    'g-plain': {'etag': '11'},
+    'g-quoted': {'etag': 'new'},
+    'g-null': {'etag': '12'},
+    'g-missing': {'etag': '13'},
+    'g-flow': {'etag': '21'},
+    'g-flow-missing': {'etag': '22'},
+    'g-same': {'etag': '30'},
+}
+
+
+def update_etags_incremental_output(tmp_path):
+    file_name = str(tmp_path / 'onboard.yaml')
+    status = update_etags_incremental(ETAG_BUILDING_CONFIG, load_rt(ONBOARD_CONFIG), ONBOARD_CONFIG, file_name)
+    with open(file_name.replace('.yaml', '_upd.yaml')) as f:
+        return status, f.read()
+
+
+def test_incremental_etags_replace_values_in_place(tmp_path):
+    status, text = update_etags_incremental_output(tmp_path)
+    lines = text.splitlines()
+    assert "  etag: '11'" in lines
+    assert "  etag: 'new'   # etag from last export" in lines
+    assert "g-flow: {code: FLOW, etag: '21', operation: UPDATE}" in lines
+    assert "  etag: '30'" in lines
+    assert status['changed_etags'] == ['g-plain', 'g-quoted', 'g-null', 'g-missing', 'g-flow']
+
+
+def test_incremental_etags_fill_null_etag(tmp_path):
+    _, text = update_etags_incremental_output(tmp_path)
+    assert "g-null:\n  etag: '12'\n  code: EMPTY-ETAG\n" in text
+
+
+def test_incremental_etags_insert_missing_etag(tmp_path):
+    _, text = update_etags_incremental_output(tmp_path)
+    assert "g-missing:\n  etag: '13'\n  code: MISSING\n" in text
+
+
+def test_incremental_etags_report_flow_entity_without_etag(tmp_path):
+    status, text = update_etags_incremental_output(tmp_path)
+    assert status['errors'] == ["Can't add etag to flow style entity: g-flow-missing, FLOW-MISSING"]
+    assert 'g-flow-missing: {code: FLOW-MISSING, operation: UPDATE}' in text
+
+
+def test_incremental_etags_match_update_etags(tmp_path):
+    _, text = update_etags_incremental_output(tmp_path)
+    file_name = str(tmp_path / 'full.yaml')
+    update_etags(ETAG_BUILDING_CONFIG, load_rt(ONBOARD_CONFIG), file_name)
+    with open(file_name.replace('.yaml', '_upd.yaml')) as f:
+        full = YAML(typ='safe').load(f)
+    incremental = YAML(typ='safe').load(text)
+    # update_etags can add etags to flow style entities, the incremental update reports them
+    full['g-flow-missing'].pop('etag')
+    assert incremental == full
+
+
+class Moved(dict):
+    '''
+    Config class removed after a snapshot was saved with it.
+    '''
+
+
+def test_snapshot_round_trip_and_fallback(tmp_path, monkeypatch):
+    monkeypatch.setattr(onboarding_utils, 'SNAPSHOT_KEY_PATH', str(tmp_path / 'snapshot.key'))
+    source_path = str(tmp_path / 'abel.yaml')
+    with open(source_path, 'w') as f:
+        f.write(CONFIG)
+
+    for loader in ('compact', 'stream'):
+        config = load_config_snapshot(source_path, loader)
+        snapshot = load_snapshot(source_path, loader)
+        assert type(snapshot) is type(config)
+        assert type(snapshot).__module__ == 'onboarding_utils'
+        assert dict(snapshot) == dict(config)
+
+    save_snapshot(Moved(a=1), source_path, 'safe')
+    monkeypatch.delattr(sys.modules[__name__], 'Moved')
+    assert load_snapshot(source_path, 'safe') is None
+    assert load_config_snapshot(source_path, 'safe') == YAML(typ='safe').load(CONFIG)
+    assert load_snapshot(source_path, 'safe') == YAML(typ='safe').load(CONFIG)
+
+
+def test_snapshots_saved_by_command_line_load_from_imported_module(tmp_path):
+    env = dict(os.environ, ONBOARD_SNAPSHOT_KEY=str(tmp_path / 'snapshot.key'))
+    building_path = tmp_path / 'building.yaml'
+    building_path.write_text(CONFIG.split('2f0c8f0e-0000-4000-8000-000000000002:')[0].replace('CONFIG_METADATA:\n  operation: UPDATE\n', ''))
+    abel_path = tmp_path / 'abel.yaml'
+    abel_path.write_text(CONFIG)
+    subprocess.run([sys.executable, '-m', 'onboarding_utils', 'update', str(building_path), str(abel_path), str(tmp_path / 'onboard.yaml'),
+                    '--stream', '--compact', '--snapshot'], cwd=os.path.dirname(onboarding_utils.__file__), env=env, check=True,
+                   stdout=subprocess.DEVNULL)
+
+    code = (f'import onboarding_utils; '
+            f'print(type(onboarding_utils.load_snapshot({str(abel_path)!r}, "compact")).__name__, '
+            f'type(onboarding_utils.load_snapshot({str(building_path)!r}, "stream")).__name__)')
+    output = subprocess.run([sys.executable, '-c', code], cwd=os.path.dirname(onboarding_utils.__file__), env=env, check=True,
+                            capture_output=True, text=True).stdout
+    assert output.split() == ['CompactConfig', 'PartialConfig']
+
+
+LINKED_CONFIG = '''\
+g-target:
+  code: FCU-1
+  etag: '10'
+g-add:
+  code: ZONE-ADD
+  links:
+    g-target: {zone_air_temperature_sensor: zone_air_temperature_sensor}
+  operation: ADD
+g-update:
+  code: ZONE-UPDATE
+  links:
+    g-target: {supply_air_flow_sensor: supply_air_flow_sensor}
+  operation: UPDATE
+'''
+
+
+def test_link_graph_reports_target_linked_from_add_and_update():
+    abel_config = load_rt(LINKED_CONFIG)
+    link_graph = LinkGraph(abel_config, {})
+    assert link_graph.duplicates == [('g-update', 'g-target', 'g-add')]
+    assert link_graph.errors() == ['Link g-target from ZONE-UPDATE (guid: g-update) is also linked from ADD entity ZONE-ADD (guid: g-add), '
+                                   'it would be exported in both add and update configs.']
+    assert validate_configs({}, abel_config, 'add-virtual')['duplicate_links'] == link_graph.duplicates
+    # without ABEL flags all virtual entities are added
+    assert LinkGraph(abel_config, {}, abel_flags=False).duplicates == []
+
+
+def test_link_graph_reports_repeated_links_built_in_code():
+    abel_config = load_rt(LINKED_CONFIG)
+    abel_config['g-add']['links'] = ['g-target', 'g-target']
+    link_graph = LinkGraph(abel_config, {})
+    assert link_graph.adjacency['g-add'] == ('g-target',)
+    assert ('g-add', 'g-target', 'g-add') in link_graph.duplicates
+    assert 'Duplicate link g-target from ZONE-ADD (guid: g-add).' in link_graph.errors()
@@ -0,0 +1,122 @@
+import asyncio
+import os
+import shlex
+import stat
+
+import pytest
+
+from stubby_utils import (LocalTransport, OperationPoll, StubbyTransport, Transport, onboard_building_command, onboard_script,
+                          wait_for_operations)
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    '''
+    Delays the poller sleeps for, without sleeping.
+    '''
+    delays = []
+    real_sleep = asyncio.sleep
+
+    async def sleep(delay):
+        delays.append(delay)
+        await real_sleep(0)
+
+    monkeypatch.setattr(asyncio, 'sleep', sleep)
+    return delays
+
+
+class FlakyTransport(Transport):
+    '''
+    Fails the first calls for every operation, then reports it done.
+    '''
+    def __init__(self, failures):
+        self.failures = failures
+        self.calls = 0
+
+    async def get_operation(self, building_code, operation_id):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise RuntimeError('connection reset')
+        return {'done': True, 'error': None}
+
+
+def test_transport_is_abstract():
+    with pytest.raises(TypeError):
+        Transport()
+
+
+def test_backoff_grows_to_max_delay(sleeps):
+    transport = LocalTransport(polls_until_done={'op-1': 5})
+    results = wait_for_operations(transport, 'US-MTV-1', ['op-1'], initial_delay=1, max_delay=5, backoff=2)
+    assert results == [{'operation_id': 'op-1', 'done': True, 'error': None, 'polls': 5}]
+    assert sleeps == [1, 2, 4, 5]
+    assert transport.calls == ['op-1'] * 5
+
+
+def test_results_in_order_of_operation_ids(sleeps):
+    transport = LocalTransport(polls_until_done={'op-1': 3, 'op-2': 1})
+    results = wait_for_operations(transport, 'US-MTV-1', ['op-1', 'op-2'], initial_delay=1)
+    assert [result['operation_id'] for result in results] == ['op-1', 'op-2']
+    assert [result['polls'] for result in results] == [3, 1]
+
+
+def test_failed_operation_reports_error(sleeps):
+    transport = LocalTransport(polls_until_done={'op-1': 2}, errors={'op-1': 'Entity not found'})
+    results = wait_for_operations(transport, 'US-MTV-1', ['op-1', 'op-2'], initial_delay=1)
+    assert results[0] == {'operation_id': 'op-1', 'done': True, 'error': 'Entity not found', 'polls': 2}
+    assert results[1]['error'] is None
+
+
+def test_timeout_reports_running_operations():
+    transport = LocalTransport(polls_until_done={'op-1': 1000})
+    results = wait_for_operations(transport, 'US-MTV-1', ['op-1', 'op-2'], initial_delay=0.01, max_delay=0.01, timeout=0.05)
+    assert results[0]['done'] is False
+    assert results[0]['error'] == 'Timed out'
+    assert 1 < results[0]['polls'] < 1000
+    assert results[1] == {'operation_id': 'op-2', 'done': True, 'error': None, 'polls': 1}
+
+
+def test_failed_calls_are_retried(sleeps):
+    transport = FlakyTransport(failures=2)
+    updates = []
+    results = wait_for_operations(transport, 'US-MTV-1', ['op-1'], initial_delay=1, on_update=updates.append)
+    assert results == [{'operation_id': 'op-1', 'done': True, 'error': None, 'polls': 3}]
+    assert [update['error'] for update in updates] == ['RuntimeError: connection reset'] * 2 + [None]
+    assert sleeps == [1, 2]
+
+
+def test_last_call_failure_is_reported_on_timeout(sleeps):
+    transport = FlakyTransport(failures=1000)
+    results = wait_for_operations(transport, 'US-MTV-1', ['op-1'], initial_delay=1, timeout=0)
+    assert results == [{'operation_id': 'op-1', 'done': False, 'error': 'RuntimeError: connection reset', 'polls': 1}]
+
+
+def test_config_paths_are_shell_quoted():
+    config_path = 'exports/$USER "new"/onboard_update_pt1.yaml'
+    assert f'topology_file=readfile({config_path})' in shlex.split(onboard_building_command('US-MTV-1', config_path))
+    echo = next(line for line in onboard_script('US-MTV-1', [config_path]).splitlines() if line.startswith('echo "[1/1]"'))
+    assert shlex.split(echo.split(' | ')[0]) == ['echo', '[1/1]', config_path]
+
+
+def test_operation_ids_are_not_expanded_by_a_shell(tmp_path, monkeypatch):
+    # fake stubby saving its last argument, the GetOperation request
+    stubby = tmp_path / 'stubby'
+    stubby.write_text('#!/bin/sh\nfor arg; do last="$arg"; done\nprintf \'%s\' "$last" > "$(dirname "$0")/request"\necho "done: true"\n')
+    stubby.chmod(stubby.stat().st_mode | stat.S_IEXEC)
+    monkeypatch.setenv('PATH', f"{tmp_path}{os.pathsep}{os.environ['PATH']}")
+    operation_id = f'$(touch${{IFS}}{tmp_path}/pwned)'
+
+    result = asyncio.run(StubbyTransport(timeout=10).get_operation('US-MTV-1', operation_id))
+    assert result == {'done': True, 'error': None}
+    assert not (tmp_path / 'pwned').exists()
+    assert (tmp_path / 'request').read_text().endswith(f"operation_name: '{operation_id}'")
+
+
+def test_operation_poll_runs_in_background():
+    poll = OperationPoll(LocalTransport(polls_until_done={'op-1': 2}, errors={'op-2': 'Entity not found'}), 'US-MTV-1', ['op-1', 'op-2'],
+                         initial_delay=0.01)
+    assert [state['operation_id'] for state in poll.states()] == ['op-1', 'op-2']
+    poll._thread.join(5)
+    assert poll.done
+    assert poll.error is None
+    assert [(result['done'], result['error']) for result in poll.results()] == [(True, None), (True, 'Entity not found')]